@@ -40,8 +40,13 @@ from functools import wraps
 from collections import namedtuple
 from tempfile import NamedTemporaryFile
 from hosted.scheduler import timespec_from_config
+from hosted.expanded import (
+    ExpandedSpans, ExpandedSchedules, OptionExpandedSchedule,
+    scratch_file, write_scratch_file,
+)
 
 _types = {}
+_plain_types = set()
 
 class OptionValueWrapper(object):
     def __init__(self, value):
@@ -51,43 +56,26 @@ class OptionSection(OptionValueWrapper):
     def is_selected(self, key):
         return key in self._value
 
-class OptionExpandedSchedule(object):
-    def __init__(self, value, schedules):
-        self._value = value
-        self._schedules = schedules
-
-    def within_range(self, start, duration, probe):
-        return start <= probe < start + duration
-
-    def is_active_at(self, unix_time):
-        if self._value == 'always':
-            return True
-        elif self._value == 'never':
-            return False
-        start, duration = self._schedules['range']
-        if not self.within_range(start, duration, unix_time):
-            return False
-        for start, duration in self._schedules['expanded'][self._value]:
-            if start > unix_time:
-                return False
-            elif self.within_range(start, duration, unix_time):
-                return True
-        return False
-
 def init_types():
     def type(fn):
         _types[fn.__name__] = fn
         return fn
 
-    @type
+    def plain(fn):
+        # Values of these types are used as they are. The
+        # compiled parsers copy them without calling fn.
+        _plain_types.add(fn.__name__)
+        return type(fn)
+
+    @plain
     def color(value):
         return value
 
-    @type
+    @plain
     def string(value):
         return value
 
-    @type
+    @plain
     def text(value):
         return value
 
@@ -95,63 +83,63 @@ def init_types():
     def section(value):
         return OptionSection(value)
 
-    @type
+    @plain
     def boolean(value):
         return value
 
-    @type
+    @plain
     def select(value):
         return value
 
-    @type
+    @plain
     def duration(value):
         return value
 
-    @type
+    @plain
     def integer(value):
         return value
 
-    @type
+    @plain
     def float(value):
         return value
 
-    @type
+    @plain
     def font(value):
         return value
 
-    @type
+    @plain
     def device(value):
         return value
 
-    @type
+    @plain
     def resource(value):
         return value
 
-    @type
+    @plain
     def device_token(value):
         return value
 
-    @type
+    @plain
     def json(value):
         return value
 
-    @type
+    @plain
     def id(value):
         return value
 
-    @type
+    @plain
     def playlist(value):
         return value
 
-    @type
+    @plain
     def list_select(value):
         return value
 
-    @type
+    @plain
     def custom(value):
         return value
 
-    @type
+    @plain
     def date(value):
         return value
 
@@ -161,6 +149,140 @@ def init_types():
 
 init_types()
 
+def compile_options(options, expanded_schedules):
+    """
+    Compiles the options of a node.json into a function parsing
+    a matching config object:
+
+        parse(config, prev_config, prev_parsed, state)
+
+    prev_config and prev_parsed are the raw and parsed values of
+    the previous revision, or None. Unchanged values are taken
+    from those. state is a (schedules, shareable, stats) tuple; see
+    Configuration.parse_config_json. Also returns whether parsed
+    values are bound to the schedules.
+    """
+    plain, fields = [], []
+    for option in options:
+        if not 'name' in option:
+            continue
+        name, option_type = option['name'], option['type']
+        if option_type == 'list':
+            convert, bound = compile_list(option['items'], expanded_schedules)
+        elif option_type == 'schedule' and expanded_schedules:
+            def convert(value, prev_raw, prev_value, state):
+                return OptionExpandedSchedule(value, state[0])
+            bound = True
+        elif option_type in _plain_types:
+            plain.append(name)
+            continue
+        else:
+            def convert(value, prev_raw, prev_value, state, fn=_types[option_type]):
+                return fn(value)
+            bound = False
+        fields.append((name, convert, bound))
+
+    def parse(config, prev_config, prev_parsed, state):
+        if prev_config is None:
+            parsed = {}
+            for name in plain:
+                if name in config:
+                    parsed[name] = config[name]
+            for name, convert, bound in fields:
+                if name in config:
+                    parsed[name] = convert(config[name], None, None, state)
+            return parsed
+        # The parsed value of a plain option is its raw value, so
+        # an unchanged one is shared by reusing the previous raw value.
+        parsed = {}
+        for name in plain:
+            if name in config:
+                value = config[name]
+                prev_value = prev_config.get(name, value)
+                parsed[name] = prev_value if prev_value == value else value
+        _, shareable, stats = state
+        for name, convert, bound in fields:
+            if not name in config:
+                continue
+            value = config[name]
+            if name in prev_config:
+                prev_raw, prev_value = prev_config[name], prev_parsed[name]
+                if prev_raw == value and (shareable or not bound):
+                    stats[0] += 1
+                    parsed[name] = prev_value
+                    continue
+            else:
+                prev_raw, prev_value = None, None
+            stats[1] += 1
+            parsed[name] = convert(value, prev_raw, prev_value, state)
+        return parsed
+    return parse, any(bound for _, _, bound in fields)
+
+def compile_list(options, expanded_schedules):
+    parse_item, bound = compile_options(options, expanded_schedules)
+    id_names = [
+        option['name'] for option in options
+        if option['type'] == 'id' and 'name' in option
+    ]
+
+    def item_key(item):
+        for name in id_names:
+            if name in item:
+                return item[name]
+        # Not using sort_keys, as that's not handled by the C
+        # encoder. A different key order only prevents sharing.
+        return json.dumps(item)
+
+    def convert(items, prev_items, prev_parsed, state):
+        if prev_items is None:
+            return [parse_item(item, None, None, state) for item in items]
+        # Previous items are matched by position first. Items
+        # that moved are found by their id option or, lacking
+        # one, their content. Otherwise the item at the same
+        # position still provides its unchanged values.
+        _, shareable, stats = state
+        by_key = None
+        parsed = []
+        for idx, item in enumerate(items):
+            if idx < len(prev_items):
+                prev_item, prev_value = prev_items[idx], prev_parsed[idx]
+            else:
+                prev_item, prev_value = None, None
+            if prev_item != item:
+                if by_key is None:
+                    by_key = dict(
+                        (item_key(prev_item), (prev_item, prev_value))
+                        for prev_item, prev_value in zip(prev_items, prev_parsed)
+                    )
+                prev_item, prev_value = by_key.get(
+                    item_key(item), (prev_item, prev_value)
+                )
+            if prev_item == item and (shareable or not bound):
+                stats[0] += 1
+                parsed.append(prev_value)
+                continue
+            stats[1] += 1
+            parsed.append(parse_item(item, prev_item, prev_value, state))
+        return parsed
+    return convert, bound
+
+# Compiled parsers by node directory. Changing a node.json
+# restarts the service, so they never have to be invalidated.
+_parsers = {}
+
+def node_parser(path):
+    path = os.path.abspath(path)
+    parser = _parsers.get(path)
+    if parser is None:
+        with open(os.path.join(path, "node.json")) as f:
+            node_json = json.load(f)
+        expanded_schedules = node_json.get('expand_schedules', False)
+        parse, _ = compile_options(
+            node_json.get('options', []), expanded_schedules
+        )
+        parser = _parsers[path] = expanded_schedules, parse
+    return parser
+
 def log(msg, name='hosted.py'):
     sys.stderr.write("[{}] {}\n".format(name, msg))
 
@@ -468,10 +590,11 @@ class Configuration(object):
     def __init__(self, path=''):
         self._path = path
         self._restart = False
-        with open(os.path.join(self._path, "node.json")) as f:
-            node_json = json.load(f)
-            self._expanded_schedules = node_json.get('expand_schedules', False)
-            self._options = node_json.get('options', [])
+        # Shared by all configurations of the same node
+        self._expanded_schedules, self._parse = node_parser(self._path)
+        self._config = None
+        self._parsed = None
+        self._schedules = None
         self.parse_config_json()
 
     @property
@@ -483,8 +606,10 @@ class Configuration(object):
         self._restart = True
 
     def parse_config_json(self):
+        started = time.time()
         with open(os.path.join(self._path, "config.json")) as f:
-            config = json.load(f)
+            raw = f.read()
+        config = json.loads(raw)
 
         if self._restart:
             return abort_service("restart_on_update set")
@@ -498,31 +623,49 @@ class Configuration(object):
                 parsed[key] = value
             return parsed
 
-        schedules = config.get('__schedules')
-
-        def parse_recursive(options, config):
-            parsed = {}
-            for option in options:
-                if not 'name' in option or not option['name'] in config:
-                    continue
-                if option['type'] == 'list':
-                    items = []
-                    for item in config[option['name']]:
-                        items.append(parse_recursive(option['items'], item))
-                    parsed[option['name']] = items
-                    continue
-                if option['type'] == 'schedule' and self._expanded_schedules:
-                    parsed[option['name']] = OptionExpandedSchedule(
-                        config[option['name']], schedules
-                    )
-                else:
-                    parsed[option['name']] = _types[option['type']](config[option['name']])
-            return parsed
-
-        parsed = parse_recursive(self._options, config)
-        parsed['__metadata'] = parse_metadata(config['__metadata'])
-        log("updated %s" % os.path.join(self._path, 'config.json'))
-        self._parsed, self._config = ParsedConfig(parsed), config
+        metadata = parse_metadata(config['__metadata'])
+
+        # Converted once per parse. All options referencing the
+        # same schedule share the resulting span arrays. If the
+        # schedules didn't change, the previous instance is kept.
+        previous = self._config
+        timezone = config['__metadata'].get('timezone')
+        if (self._expanded_schedules and previous is not None and
+                previous['__metadata'].get('timezone') == timezone and
+                previous.get('__schedules') == config.get('__schedules')):
+            schedules = self._schedules
+        else:
+            schedules = ExpandedSchedules(
+                config.get('__schedules'), timezone,
+                cache = os.path.abspath(
+                    self._path
+                ) if self._expanded_schedules else None,
+            )
+        # Values parsed from an unchanged raw value are taken from
+        # the previous parse, so unchanged subtrees are shared
+        # between snapshots. Values bound to the schedules can only
+        # be shared if those were kept as well.
+        stats = [0, 0]
+        parsed = self._parse(
+            config, previous,
+            None if previous is None else self._parsed._parsed,
+            (schedules, schedules is self._schedules, stats),
+        )
+        parsed['__metadata'] = metadata
+        if previous is None:
+            log("updated %s in %.1fms" % (
+                os.path.join(self._path, 'config.json'),
+                (time.time() - started) * 1000,
+            ))
+        else:
+            log("updated %s in %.1fms (%d values shared, %d parsed)" % (
+                os.path.join(self._path, 'config.json'),
+                (time.time() - started) * 1000,
+                stats[0], stats[1],
+            ))
+        self._parsed, self._config, self._schedules = (
+            ParsedConfig(parsed), config, schedules
+        )
 
     @property
     def raw(self):
@@ -0,0 +1,356 @@
+import os, sys, time, traceback, hashlib, struct, marshal
+from array import array
+from bisect import bisect_left, bisect_right
+from tempfile import NamedTemporaryFile
+
+def log(msg, name='expanded.py'):
+    sys.stderr.write("[{}] {}\n".format(name, msg))
+
+class ExpandedSpans(object):
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self, spans):
+        # Overlapping or adjacent spans are merged, so the
+        # resulting start/end arrays are both sorted and a
+        # single bisect is enough to answer a lookup.
+        starts, ends = array('d'), array('d')
+        for start, duration in sorted(spans):
+            end = start + duration
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.starts = starts
+        self.ends = ends
+
+    # Written as a span count followed by the start and end arrays
+    # as native doubles, so reading back doesn't need to merge again.
+    def write(self, f):
+        f.write(struct.pack('<I', len(self.starts)))
+        f.write(self.starts.tostring())
+        f.write(self.ends.tostring())
+
+    @classmethod
+    def read(cls, f):
+        num_spans, = struct.unpack('<I', f.read(4))
+        spans = cls.__new__(cls)
+        spans.starts, spans.ends = array('d'), array('d')
+        spans.starts.fromfile(f, num_spans)
+        spans.ends.fromfile(f, num_spans)
+        return spans
+
+    def as_list(self):
+        return [
+            [start, end - start]
+            for start, end in zip(self.starts, self.ends)
+        ]
+
+    def is_active_at(self, unix_time):
+        idx = bisect_right(self.starts, unix_time) - 1
+        return idx >= 0 and unix_time < self.ends[idx]
+
+    def is_active_at_many(self, unix_times):
+        # Walks the sorted probes and spans in parallel.
+        active = bytearray(len(unix_times))
+        starts, ends = self.starts, self.ends
+        idx, num_spans = 0, len(starts)
+        for pos, unix_time in enumerate(unix_times):
+            while idx < num_spans and ends[idx] <= unix_time:
+                idx += 1
+            if idx == num_spans:
+                break
+            if starts[idx] <= unix_time:
+                active[pos] = 1
+        return active
+
+    def next_transition(self, unix_time):
+        idx = bisect_right(self.starts, unix_time)
+        if idx > 0 and unix_time < self.ends[idx-1]:
+            return self.ends[idx-1]
+        if idx < len(self.starts):
+            return self.starts[idx]
+        return None
+
+def scratch_file(prefix, key):
+    scratch = os.environ.get('SCRATCH')
+    if scratch is None:
+        return None
+    return os.path.join(scratch, '%s-%s.bin' % (
+        prefix, hashlib.sha1(key).hexdigest()
+    ))
+
+def write_scratch_file(filename, writer):
+    f = NamedTemporaryFile(prefix='scratch-tmp', dir=os.path.dirname(filename))
+    try:
+        writer(f)
+    except:
+        traceback.print_exc()
+        f.close()
+    else:
+        f.delete = False
+        f.close()
+        os.rename(f.name, filename)
+
+class ExpandedSchedules(object):
+    def __init__(self, schedules, tz=None, cache=None):
+        if schedules is None:
+            schedules = dict(range=(0, 0), expanded={})
+        self._range = schedules['range']
+        self._spans = self.load_spans(
+            schedules['expanded'], self._range, tz, cache
+        )
+
+    @staticmethod
+    def load_spans(expanded, schedule_range, tz, cache):
+        """
+        Converts the expanded schedules to ExpandedSpans. If cache
+        is given as the node path, each schedule's result is kept in
+        its own file in SCRATCH, versioned by a hash of its spans,
+        the timezone and the range. Restarting the service reads the
+        merged span arrays back and only schedules that changed get
+        converted and written again.
+        """
+        started = time.time()
+        if cache is None or os.environ.get('SCRATCH') is None:
+            prefix = None
+        else:
+            prefix = 'schedule-spans-%s' % hashlib.sha1(cache).hexdigest()[:12]
+        spans, filenames, converted = {}, set(), 0
+        for value, value_spans in expanded.iteritems():
+            if prefix is None:
+                spans[value] = ExpandedSpans(value_spans)
+                converted += 1
+                continue
+            filename = scratch_file(prefix, value.encode('utf8'))
+            filenames.add(os.path.basename(filename))
+            version = hashlib.sha1(
+                marshal.dumps((tz, tuple(schedule_range), value_spans))
+            ).digest()
+            try:
+                with open(filename, 'rb') as f:
+                    if f.read(len(version)) == version:
+                        spans[value] = ExpandedSpans.read(f)
+            except (IOError, EOFError, struct.error):
+                pass
+            if value not in spans:
+                spans[value] = ExpandedSpans(value_spans)
+                converted += 1
+                def writer(f, version=version, value_spans=spans[value]):
+                    f.write(version)
+                    value_spans.write(f)
+                write_scratch_file(filename, writer)
+        if prefix is not None:
+            # Files of schedules no longer in the config.
+            scratch = os.environ['SCRATCH']
+            for filename in os.listdir(scratch):
+                if filename.startswith(prefix) and filename not in filenames:
+                    try:
+                        os.unlink(os.path.join(scratch, filename))
+                    except OSError:
+                        pass
+        if spans:
+            log("loaded %d expanded schedules (%d read, %d converted) in %.1fms" % (
+                len(spans), len(spans) - converted, converted,
+                (time.time() - started) * 1000,
+            ))
+        return spans
+
+    @property
+    def range(self):
+        return self._range
+
+    def spans(self, value):
+        return self._spans.get(value)
+
+class OptionExpandedSchedule(object):
+    def __init__(self, value, schedules):
+        self._value = value
+        self._schedules = schedules
+        self._spans = schedules.spans(value)
+
+    def within_range(self, start, duration, probe):
+        return start <= probe < start + duration
+
+    def is_active_at(self, unix_time):
+        if self._value == 'always':
+            return True
+        elif self._value == 'never':
+            return False
+        start, duration = self._schedules.range
+        if not self.within_range(start, duration, unix_time):
+            return False
+        if self._spans is None:
+            return False
+        return self._spans.is_active_at(unix_time)
+
+    def is_active_at_many(self, unix_times):
+        """
+        Returns a bytearray with the result of is_active_at for
+        each of the sorted unix_times, computed in a single pass
+        over the probes and spans.
+        """
+        if self._value == 'always':
+            return bytearray([1]) * len(unix_times)
+        active = bytearray(len(unix_times))
+        if self._value == 'never' or self._spans is None:
+            return active
+        start, duration = self._schedules.range
+        lo = bisect_left(unix_times, start)
+        hi = bisect_left(unix_times, start + duration)
+        active[lo:hi] = self._spans.is_active_at_many(unix_times[lo:hi])
+        return active
+
+    def next_transition(self, unix_time):
+        """
+        Returns the earliest time after unix_time at which
+        is_active_at might return a different result, or None
+        if the result won't change anymore.
+        """
+        if self._value in ('always', 'never'):
+            return None
+        start, duration = self._schedules.range
+        end = start + duration
+        if unix_time < start:
+            return start
+        if unix_time >= end:
+            return None
+        if self._spans is None:
+            return end
+        transition = self._spans.next_transition(unix_time)
+        if transition is None or transition > end:
+            return end
+        return transition
+
+if __name__ == "__main__":
+    import unittest, json
+
+    # Shaped like the config.json shipped for the playlist node with
+    # expand_schedules set: Schedule options reference schedules by
+    # id and __schedules has their spans within the shipped range.
+    CONFIG = '''{
+        "__metadata": {"timezone": "Europe/Berlin"},
+        "__schedules": {
+            "range": [1710000000, 604800],
+            "expanded": {
+                "1001": [[1710003600, 1800], [1710005000, 1000], [1710090000, 3600]],
+                "1002": []
+            }
+        },
+        "playlist": [
+            {"asset": "empty.png", "duration": 10, "schedule": "always"},
+            {"asset": "empty.png", "duration": 10, "schedule": "1001"},
+            {"asset": "empty.png", "duration": 10, "schedule": "1002"},
+            {"asset": "empty.png", "duration": 10, "schedule": "1003"},
+            {"asset": "empty.png", "duration": 10, "schedule": "never"}
+        ]
+    }'''
+
+    class TestExpandedSchedule(unittest.TestCase):
+        def setUp(self):
+            self.config = json.loads(CONFIG)
+            self.schedules = ExpandedSchedules(self.config['__schedules'])
+            self.options = [
+                OptionExpandedSchedule(item['schedule'], self.schedules)
+                for item in self.config['playlist']
+            ]
+
+        def expected(self, value, unix_time):
+            if value in ('always', 'never'):
+                return value == 'always'
+            start, duration = self.config['__schedules']['range']
+            if not start <= unix_time < start + duration:
+                return False
+            return any(
+                span_start <= unix_time < span_start + span_duration
+                for span_start, span_duration
+                in self.config['__schedules']['expanded'].get(value, ())
+            )
+
+        def test_matches_spans(self):
+            start, duration = self.config['__schedules']['range']
+            probes = range(start - 3600, start + duration + 3600, 97)
+            for item, option in zip(self.config['playlist'], self.options):
+                expected = [
+                    int(self.expected(item['schedule'], unix_time))
+                    for unix_time in probes
+                ]
+                self.assertEqual(
+                    [int(option.is_active_at(unix_time)) for unix_time in probes],
+                    expected,
+                )
+                self.assertEqual(list(option.is_active_at_many(probes)), expected)
+
+        def test_transitions(self):
+            start, duration = self.config['__schedules']['range']
+            option = self.options[1]
+            transitions, unix_time = [], start - 3600
+            while unix_time is not None:
+                transitions.append(unix_time)
+                unix_time = option.next_transition(unix_time)
+            # Overlapping spans are merged. Nothing changes after
+            # the end of the range.
+            self.assertEqual(transitions[1:], [
+                1710000000, 1710003600, 1710006000, 1710090000, 1710093600,
+                1710604800,
+            ])
+
+    class TestSpanCache(unittest.TestCase):
+        def setUp(self):
+            import tempfile
+            self.scratch = tempfile.mkdtemp()
+            self.saved = os.environ.get('SCRATCH'), write_scratch_file
+            os.environ['SCRATCH'] = self.scratch
+            self.schedules = json.loads(CONFIG)['__schedules']
+            self.written = []
+            def recording_write_scratch_file(filename, writer):
+                self.written.append(filename)
+                self.saved[1](filename, writer)
+            globals()['write_scratch_file'] = recording_write_scratch_file
+
+        def tearDown(self):
+            import shutil
+            shutil.rmtree(self.scratch)
+            scratch, globals()['write_scratch_file'] = self.saved
+            if scratch is None:
+                del os.environ['SCRATCH']
+            else:
+                os.environ['SCRATCH'] = scratch
+
+        def load(self, tz='Europe/Berlin'):
+            del self.written[:]
+            return ExpandedSchedules(self.schedules, tz, cache='/node')
+
+        def test_rewrites_changed_schedules_only(self):
+            self.load()
+            files = self.written[:]
+            self.assertEqual(len(files), 2)
+
+            # Unchanged schedules are read back, not written again.
+            schedules = self.load()
+            self.assertEqual(self.written, [])
+            self.assertEqual(schedules.spans('1001').as_list(), [
+                [1710003600, 2400], [1710090000, 3600],
+            ])
+
+            self.schedules['expanded']['1002'] = [[1710010000, 600]]
+            schedules = self.load()
+            self.assertEqual(len(self.written), 1)
+            self.assertEqual(schedules.spans('1002').as_list(), [
+                [1710010000, 600],
+            ])
+
+            # The timezone and range are part of each version.
+            self.load(tz='UTC')
+            self.assertEqual(sorted(self.written), sorted(files))
+            self.schedules['range'] = [1710000000, 86400]
+            self.load(tz='UTC')
+            self.assertEqual(sorted(self.written), sorted(files))
+
+        def test_removes_dropped_schedules(self):
+            self.load()
+            del self.schedules['expanded']['1002']
+            self.load()
+            self.assertEqual(len(os.listdir(self.scratch)), 1)
+
+    unittest.main()
@@ -5,12 +5,14 @@ the recurrence rules documented in the
 `iCalendar RFC <https://tools.ietf.org/html/rfc5545>`_,
 including support for caching of results.
 """
+import bisect
 import calendar
 import datetime
 import heapq
 import itertools
 import re
 import sys
+from collections import deque
 from functools import wraps
 # For warning about deprecation of until and count
 from warnings import warn
@@ -93,6 +95,15 @@ FREQNAMES = ['YEARLY', 'MONTHLY', 'WEEKLY', 'DAILY', 'HOURLY', 'MINUTELY', 'SECO
  MINUTELY,
  SECONDLY) = list(range(7))
 
+# Number of iterated periods between two checkpoints of a COUNT
+# limited rule. See rrule._seek_period.
+CHECKPOINT_PERIODS = 32
+
+# Size of the windows kept by rrules with window_cache enabled and
+# the maximum number of windows kept per rule. See rrule._window.
+WINDOW_DAYS = 14
+MAX_CACHED_WINDOWS = 6
+
 # Imported on demand.
 easter = None
 parser = None
@@ -203,11 +214,20 @@ class rrulebase(object):
         else:
             return list(iter(self))[item]
 
+    def _iter_from(self, dt):
+        """ Returns an iterator over the recurrences starting no later than
+            the first recurrence at or after dt. Subclasses that can skip
+            ahead override this. Recurrences before dt might still be
+            included, so callers have to filter them. """
+        if self._cache_complete:
+            return iter(self._cache)
+        return iter(self)
+
     def __contains__(self, item):
         if self._cache_complete:
             return item in self._cache
         else:
-            for i in self:
+            for i in self._iter_from(item):
                 if i == item:
                     return True
                 elif i > item:
@@ -248,10 +268,7 @@ class rrulebase(object):
         """ Returns the first recurrence after the given datetime instance. The
             inc keyword defines what happens if dt is an occurrence. With
             inc=True, if dt itself is an occurrence, it will be returned.  """
-        if self._cache_complete:
-            gen = self._cache
-        else:
-            gen = self
+        gen = self._iter_from(dt)
         if inc:
             for i in gen:
                 if i >= dt:
@@ -281,10 +298,7 @@ class rrulebase(object):
         :yields: Yields a sequence of `datetime` objects.
         """
 
-        if self._cache_complete:
-            gen = self._cache
-        else:
-            gen = self
+        gen = self._iter_from(dt)
 
         # Select the comparison function
         if inc:
@@ -307,10 +321,7 @@ class rrulebase(object):
         The inc keyword defines what happens if after and/or before are
         themselves occurrences. With inc=True, they will be included in the
         list, if they are found in the recurrence set. """
-        if self._cache_complete:
-            gen = self._cache
-        else:
-            gen = self
+        gen = self._iter_from(after)
         started = False
         l = []
         if inc:
@@ -458,13 +469,18 @@ class rrule(rrulebase):
         If given, it must be a boolean value specifying to enable or disable
         caching of results. If you will use the same rrule instance multiple
         times, enabling caching will improve the performance considerably.
+    :param window_cache:
+        If True, DAILY, WEEKLY and MONTHLY rules keep the recurrences of
+        the most recently used WINDOW_DAYS long windows. Unlike cache, this
+        keeps memory bounded while repeated lookups around the same dates
+        are answered without iterating the rule again.
      """
     def __init__(self, freq, dtstart=None,
                  interval=1, wkst=None, count=None, until=None, bysetpos=None,
                  bymonth=None, bymonthday=None, byyearday=None, byeaster=None,
                  byweekno=None, byweekday=None,
                  byhour=None, byminute=None, bysecond=None,
-                 cache=False, max_year=datetime.MAXYEAR):
+                 cache=False, max_year=datetime.MAXYEAR, window_cache=False):
         super(rrule, self).__init__(cache)
         global easter
         if not dtstart:
@@ -483,6 +499,21 @@ class rrule(rrulebase):
         self._count = count
         self._max_year = max_year
 
+        # DAILY, WEEKLY and MONTHLY periods can be computed directly,
+        # so iteration can skip ahead to any date. See _iter_from.
+        self._seekable = freq in (MONTHLY, WEEKLY, DAILY)
+        self._checkpoints = {}
+        self._checkpoint_keys = []
+
+        # Recurrences by window index. _windows_exhausted is the
+        # index of the window the rule ends in, once known.
+        if window_cache and self._seekable:
+            self._windows = {}
+            self._windows_lock = _thread.allocate_lock()
+        else:
+            self._windows = None
+        self._windows_exhausted = None
+
         # Cache the original byxxx rules, if they are provided, as the _byxxx
         # attributes do not necessarily map to the inputs, and this can be
         # a problem in generating the strings. Only store things if they've
@@ -732,6 +763,10 @@ class rrule(rrulebase):
             self._timeset.sort()
             self._timeset = tuple(self._timeset)
 
+        # DAILY and WEEKLY rules only filtered by weekday are answered
+        # arithmetically instead of being iterated. See _simple_pattern.
+        self._simple = self._simple_pattern()
+
     def __str__(self):
         """
         Output a string that would generate this RRULE if passed to rrulestr.
@@ -803,15 +838,275 @@ class rrule(rrulebase):
                       "freq": self._freq,
                       "until": self._until,
                       "wkst": self._wkst,
-                      "cache": False if self._cache is None else True }
+                      "cache": False if self._cache is None else True,
+                      "window_cache": self._windows is not None }
         new_kwargs.update(self._original_rule)
         new_kwargs.update(kwargs)
         return rrule(**new_kwargs)
 
-    def _iter(self):
+    def _period_key(self, year, month, day):
+        if self._freq == MONTHLY:
+            return year * 12 + month - 1
+        return datetime.date(year, month, day).toordinal()
+
+    def _add_checkpoint(self, key, state):
+        # The dict entry is written before the key becomes visible
+        # through the sorted key list, so concurrent readers never
+        # find a key without its state.
+        if key in self._checkpoints:
+            return
+        self._checkpoints[key] = state
+        bisect.insort(self._checkpoint_keys, key)
+
+    def _seek_period(self, dt):
+        """
+        Returns the iteration state (year, month, day, weekday, emitted)
+        of the latest DAILY/WEEKLY/MONTHLY period starting at or before
+        `dt`. `emitted` is the number of recurrences generated before
+        that period. Returns None if iteration has to start at dtstart.
+        """
+        dtstart = self._dtstart
+        interval = self._interval
+        if self._freq == MONTHLY:
+            first = dtstart.year * 12 + dtstart.month - 1
+            periods = (dt.year * 12 + dt.month - 1 - first) // interval
+            if periods <= 0:
+                return None
+            year, month = divmod(first + periods * interval, 12)
+            state = (year, month + 1, dtstart.day, dtstart.weekday())
+        else:
+            if self._freq == DAILY:
+                first = dtstart.toordinal()
+                length = interval
+            else:
+                # All weekly periods except the first one begin on wkst.
+                first = dtstart.toordinal() - (dtstart.weekday() - self._wkst) % 7
+                length = interval * 7
+            periods = (dt.toordinal() - first) // length
+            if periods <= 0:
+                return None
+            date = datetime.date.fromordinal(first + periods * length)
+            state = (date.year, date.month, date.day, date.weekday())
+
+        if self._count is None:
+            return state + (0,)
+
+        # For COUNT limited rules the number of recurrences before
+        # the target period is only known from previous iterations.
+        # Resume from the latest checkpoint recorded by them.
+        key = self._period_key(*state[:3])
+        idx = bisect.bisect_right(self._checkpoint_keys, key)
+        if idx == 0:
+            return None
+        return self._checkpoints[self._checkpoint_keys[idx - 1]]
+
+    def _simple_pattern(self):
+        """
+        DAILY and WEEKLY rules without any byxxx filter other than
+        weekdays repeat the same days every `length` days, counted from
+        `base`. For those, returns (pattern, skipped, limit), where
+        pattern is (base, length, offsets, timeset) and `offsets` are
+        the sorted day offsets of the recurrences within each repetition.
+        `skipped` is the number of candidates before dtstart and `limit`
+        the total number of recurrences. Returns None for all other rules.
+        """
+        dtstart = self._dtstart
+        if (self._freq not in (DAILY, WEEKLY) or self._tzinfo is not None or
+                self._interval < 1 or not self._timeset or
+                self._bysetpos or self._bymonth or self._byweekno or
+                self._byyearday or self._byeaster or self._bymonthday or
+                self._bynmonthday or self._bynweekday or
+                dtstart.year > self._max_year):
+            return None
+
+        start = dtstart.toordinal()
+        interval = self._interval
+        if self._freq == DAILY:
+            base = start
+            length = interval
+            if self._byweekday:
+                length = interval * 7 // gcd(interval, 7)
+            candidates = range(0, length, interval)
+        else:
+            # All weekly periods except the first one begin on wkst.
+            base = start - (dtstart.weekday() - self._wkst) % 7
+            length = interval * 7
+            candidates = range(7)
+        byweekday = self._byweekday or range(7)
+        # Ordinal 1 is a monday.
+        offsets = [offset for offset in candidates
+                   if (base + offset - 1) % 7 in byweekday]
+        if not offsets:
+            return None
+
+        pattern = (base, length, offsets, self._timeset)
+        skipped = _count_candidates(pattern, dtstart)
+
+        # Iteration ends with the first period starting after max_year.
+        # Weekly periods starting in max_year still end in the next year.
+        if self._max_year < datetime.MAXYEAR:
+            end = datetime.date(self._max_year + 1, 1, 1).toordinal()
+        else:
+            end = datetime.date.max.toordinal() + 1
+        if self._freq == WEEKLY:
+            end = base - (base - end) // length * length
+        end = min(end, datetime.date.max.toordinal() + 1)
+        limit = _count_candidates(
+            pattern, datetime.datetime.combine(
+                datetime.date.fromordinal(end - 1), datetime.time.max
+            ), inc=True
+        ) - skipped
+
+        if self._count is not None:
+            limit = min(limit, self._count)
+        if self._until:
+            if self._until < dtstart:
+                limit = 0
+            else:
+                limit = min(limit, _count_candidates(
+                    pattern, self._until, inc=True
+                ) - skipped)
+        return pattern, skipped, limit
+
+    def _simple_index(self, dt, inc=False):
+        """
+        Number of recurrences before dt, or at or before dt if `inc`
+        is True, for rules with a simple pattern.
+        """
+        pattern, skipped, limit = self._simple
+        if dt < self._dtstart:
+            return 0
+        return min(_count_candidates(pattern, dt, inc) - skipped, limit)
+
+    def _simple_nth(self, n):
+        (base, length, offsets, timeset), skipped, limit = self._simple
+        day, time = divmod(n + skipped, len(timeset))
+        periods, idx = divmod(day, len(offsets))
+        return datetime.datetime.combine(
+            datetime.date.fromordinal(base + periods * length + offsets[idx]),
+            timeset[time]
+        )
+
+    def _iter_simple(self, n):
+        limit = self._simple[-1]
+        while n < limit:
+            yield self._simple_nth(n)
+            n += 1
+
+    def _is_simple(self, dt):
+        return (self._simple is not None and not self._cache_complete and
+                dt.tzinfo is None)
+
+    def __contains__(self, item):
+        if not self._is_simple(item):
+            return super(rrule, self).__contains__(item)
+        n = self._simple_index(item)
+        return n < self._simple[-1] and self._simple_nth(n) == item
+
+    def before(self, dt, inc=False):
+        if not self._is_simple(dt):
+            return super(rrule, self).before(dt, inc)
+        n = self._simple_index(dt, inc)
+        if n == 0:
+            return None
+        return self._simple_nth(n - 1)
+
+    def after(self, dt, inc=False):
+        if not self._is_simple(dt):
+            return super(rrule, self).after(dt, inc)
+        n = self._simple_index(dt, not inc)
+        if n == self._simple[-1]:
+            return None
+        return self._simple_nth(n)
+
+    def _iter_from(self, dt):
+        if self._is_simple(dt):
+            return self._iter_simple(self._simple_index(dt))
+        if self._cache_complete or not self._seekable:
+            return super(rrule, self)._iter_from(dt)
+        if self._windows is not None and dt.year < datetime.MAXYEAR:
+            return self._iter_windows(dt)
+        return self._iter(seek=dt)
+
+    def _window_start(self, idx):
+        return datetime.datetime.fromordinal(
+            idx * WINDOW_DAYS + 1
+        ).replace(tzinfo=self._tzinfo)
+
+    def _window(self, idx):
+        """
+        Returns the recurrences within window `idx`. Windows are
+        materialized on first use. Once more than MAX_CACHED_WINDOWS
+        are kept, the earliest ones are evicted, as lookups usually
+        move forward in time.
+        """
+        occurrences = self._windows.get(idx)
+        if occurrences is not None:
+            return occurrences
+        start, end = self._window_start(idx), self._window_start(idx + 1)
+        occurrences, exhausted = [], True
+        for occurrence in self._iter(seek=start):
+            if occurrence >= end:
+                exhausted = False
+                break
+            if occurrence >= start:
+                occurrences.append(occurrence)
+        occurrences = tuple(occurrences)
+        with self._windows_lock:
+            if exhausted and (
+                self._windows_exhausted is None or idx < self._windows_exhausted
+            ):
+                self._windows_exhausted = idx
+            self._windows[idx] = occurrences
+            while len(self._windows) > MAX_CACHED_WINDOWS:
+                del self._windows[min(
+                    key for key in self._windows if key != idx
+                )]
+        return occurrences
+
+    def _iter_windows(self, dt):
+        idx = (dt.toordinal() - 1) // WINDOW_DAYS
+        for _ in range(MAX_CACHED_WINDOWS):
+            exhausted = self._windows_exhausted
+            if exhausted is not None and idx > exhausted:
+                return
+            for occurrence in self._window(idx):
+                yield occurrence
+            idx += 1
+        # Longer iterations continue uncached instead of replacing
+        # all windows kept for lookups around dt.
+        start = self._window_start(idx)
+        for occurrence in self._iter(seek=start):
+            if occurrence >= start:
+                yield occurrence
+
+    def _iter(self, seek=None):
         year, month, day, hour, minute, second, weekday, yearday, _ = \
             self._dtstart.timetuple()
 
+        total = 0
+        count = self._count
+        track_len = True
+        if seek is not None:
+            state = self._seek_period(seek)
+            if state is not None:
+                year, month, day, weekday, total = state
+                if count is not None:
+                    count -= total
+                else:
+                    track_len = False
+                if year > self._max_year:
+                    return
+
+        # COUNT limited rules remember their iteration state every
+        # CHECKPOINT_PERIODS periods, so later seeks can resume from
+        # there instead of replaying all recurrences from dtstart.
+        if self._seekable and count is not None:
+            checkpoint = self._add_checkpoint
+        else:
+            checkpoint = None
+        periods = 0
+
         # Some local variables to speed things up a bit
         freq = self._freq
         interval = self._interval
@@ -858,9 +1153,14 @@ class rrule(rrulebase):
             else:
                 timeset = gettimeset(hour, minute, second)
 
-        total = 0
-        count = self._count
         while True:
+            if checkpoint is not None:
+                if periods and periods % CHECKPOINT_PERIODS == 0:
+                    checkpoint(self._period_key(year, month, day), (
+                        year, month, day, weekday, self._count - count
+                    ))
+                periods += 1
+
             # Get dayset with the right frequency
             dayset, start, end = getdayset(year, month, day)
 
@@ -905,13 +1205,15 @@ class rrule(rrulebase):
                 poslist.sort()
                 for res in poslist:
                     if until and res > until:
-                        self._len = total
+                        if track_len:
+                            self._len = total
                         return
                     elif res >= self._dtstart:
                         if count is not None:
                             count -= 1
                             if count < 0:
-                                self._len = total
+                                if track_len:
+                                    self._len = total
                                 return
                         total += 1
                         yield res
@@ -922,13 +1224,15 @@ class rrule(rrulebase):
                         for time in timeset:
                             res = datetime.datetime.combine(date, time)
                             if until and res > until:
-                                self._len = total
+                                if track_len:
+                                    self._len = total
                                 return
                             elif res >= self._dtstart:
                                 if count is not None:
                                     count -= 1
                                     if count < 0:
-                                        self._len = total
+                                        if track_len:
+                                            self._len = total
                                         return
 
                                 total += 1
@@ -939,7 +1243,8 @@ class rrule(rrulebase):
             if freq == YEARLY:
                 year += interval
                 if year > max_year:
-                    self._len = total
+                    if track_len:
+                        self._len = total
                     return
                 ii.rebuild(year, month)
             elif freq == MONTHLY:
@@ -952,7 +1257,8 @@ class rrule(rrulebase):
                         month = 12
                         year -= 1
                     if year > max_year:
-                        self._len = total
+                        if track_len:
+                            self._len = total
                         return
                 ii.rebuild(year, month)
             elif freq == WEEKLY:
@@ -1061,7 +1367,8 @@ class rrule(rrulebase):
                             month = 1
                             year += 1
                             if year > max_year:
-                                self._len = total
+                                if track_len:
+                                    self._len = total
                                 return
                         daysinmonth = calendar.monthrange(year, month)[1]
                     ii.rebuild(year, month)
@@ -1146,6 +1453,185 @@ class rrule(rrulebase):
                 return (accumulator, value)
 
 
+def _count_candidates(pattern, dt, inc=False):
+    """
+    Returns the number of candidates of a simple rrule pattern (see
+    rrule._simple_pattern) before dt, or at or before dt if `inc` is
+    True, including those before dtstart.
+    """
+    base, length, offsets, timeset = pattern
+    periods, offset = divmod(dt.toordinal() - base, length)
+    idx = bisect.bisect_left(offsets, offset)
+    n = (periods * len(offsets) + idx) * len(timeset)
+    if idx < len(offsets) and offsets[idx] == offset:
+        if inc:
+            n += bisect.bisect_right(timeset, dt.time())
+        else:
+            n += bisect.bisect_left(timeset, dt.time())
+    return n
+
+
+class _TableCache(object):
+    """
+    Process wide, size bounded cache of the read-only tables used by
+    _iterinfo. Rules with similar parameters iterating over the same
+    years share the same tables. Lookups happen whenever iteration
+    crosses a month, so they don't take a lock. Once full, the oldest
+    tables are evicted first.
+    """
+    def __init__(self, size):
+        self._size = size
+        self._tables = {}
+        self._keys = deque()
+        self._lock = _thread.allocate_lock()
+
+    def get(self, key, build, *args):
+        table = self._tables.get(key)
+        if table is not None:
+            return table
+        table = build(*args)
+        with self._lock:
+            if key not in self._tables:
+                self._tables[key] = table
+                self._keys.append(key)
+                while len(self._keys) > self._size:
+                    del self._tables[self._keys.popleft()]
+        return table
+
+_tables = _TableCache(512)
+
+
+def _build_year_tables(year):
+    # Every mask is 7 days longer to handle cross-year weekly periods.
+    yearlen = 365 + calendar.isleap(year)
+    nextyearlen = 365 + calendar.isleap(year + 1)
+    firstyday = datetime.date(year, 1, 1)
+    yearordinal = firstyday.toordinal()
+    yearweekday = firstyday.weekday()
+    wdaymask = tuple(WDAYMASK[yearweekday:])
+    if yearlen == 365:
+        return (yearlen, nextyearlen, yearordinal, yearweekday,
+                M365MASK, MDAY365MASK, NMDAY365MASK, wdaymask, M365RANGE)
+    else:
+        return (yearlen, nextyearlen, yearordinal, yearweekday,
+                M366MASK, MDAY366MASK, NMDAY366MASK, wdaymask, M366RANGE)
+
+
+def _build_wnomask(year, wkst, byweekno):
+    (yearlen, nextyearlen, yearordinal, yearweekday,
+     mmask, mdaymask, nmdaymask, wdaymask, mrange) = _tables.get(
+        ('year', year), _build_year_tables, year
+    )
+    wnomask = [0]*(yearlen+7)
+    # no1wkst = firstwkst = wdaymask.index(wkst)
+    no1wkst = firstwkst = (7-yearweekday+wkst) % 7
+    if no1wkst >= 4:
+        no1wkst = 0
+        # Number of days in the year, plus the days we got
+        # from last year.
+        wyearlen = yearlen+(yearweekday-wkst) % 7
+    else:
+        # Number of days in the year, minus the days we
+        # left in last year.
+        wyearlen = yearlen-no1wkst
+    div, mod = divmod(wyearlen, 7)
+    numweeks = div+mod//4
+    for n in byweekno:
+        if n < 0:
+            n += numweeks+1
+        if not (0 < n <= numweeks):
+            continue
+        if n > 1:
+            i = no1wkst+(n-1)*7
+            if no1wkst != firstwkst:
+                i -= 7-firstwkst
+        else:
+            i = no1wkst
+        for j in range(7):
+            wnomask[i] = 1
+            i += 1
+            if wdaymask[i] == wkst:
+                break
+    if 1 in byweekno:
+        # Check week number 1 of next year as well
+        # TODO: Check -numweeks for next year.
+        i = no1wkst+numweeks*7
+        if no1wkst != firstwkst:
+            i -= 7-firstwkst
+        if i < yearlen:
+            # If week starts in next year, we
+            # don't care about it.
+            for j in range(7):
+                wnomask[i] = 1
+                i += 1
+                if wdaymask[i] == wkst:
+                    break
+    if no1wkst:
+        # Check last week number of last year as
+        # well. If no1wkst is 0, either the year
+        # started on week start, or week number 1
+        # got days from last year, so there are no
+        # days from last year's last week number in
+        # this year.
+        if -1 not in byweekno:
+            lyearweekday = datetime.date(year-1, 1, 1).weekday()
+            lno1wkst = (7-lyearweekday+wkst) % 7
+            lyearlen = 365+calendar.isleap(year-1)
+            if lno1wkst >= 4:
+                lno1wkst = 0
+                lnumweeks = 52+(lyearlen +
+                                (lyearweekday-wkst) % 7) % 7//4
+            else:
+                lnumweeks = 52+(yearlen-no1wkst) % 7//4
+        else:
+            lnumweeks = -1
+        if lnumweeks in byweekno:
+            for i in range(no1wkst):
+                wnomask[i] = 1
+    return tuple(wnomask)
+
+
+def _build_nwdaymask(year, month, bymonth, bynweekday):
+    # month is given for MONTHLY rules, bymonth optionally for
+    # YEARLY rules.
+    (yearlen, nextyearlen, yearordinal, yearweekday,
+     mmask, mdaymask, nmdaymask, wdaymask, mrange) = _tables.get(
+        ('year', year), _build_year_tables, year
+    )
+    ranges = []
+    if month is not None:
+        ranges = [mrange[month-1:month+1]]
+    elif bymonth:
+        for month in bymonth:
+            ranges.append(mrange[month-1:month+1])
+    else:
+        ranges = [(0, yearlen)]
+    # Weekly frequency won't get here, so we may not
+    # care about cross-year weekly periods.
+    nwdaymask = [0]*yearlen
+    for first, last in ranges:
+        last -= 1
+        for wday, n in bynweekday:
+            if n < 0:
+                i = last+(n+1)*7
+                i -= (wdaymask[i]-wday) % 7
+            else:
+                i = first+(n-1)*7
+                i += (7-wdaymask[i]+wday) % 7
+            if first <= i <= last:
+                nwdaymask[i] = 1
+    return tuple(nwdaymask)
+
+
+def _build_eastermask(year, byeaster):
+    yearlen = 365 + calendar.isleap(year)
+    eastermask = [0]*(yearlen+7)
+    eyday = easter.easter(year).toordinal()-datetime.date(year, 1, 1).toordinal()
+    for offset in byeaster:
+        eastermask[eyday+offset] = 1
+    return tuple(eastermask)
+
+
 class _iterinfo(object):
     __slots__ = ["rrule", "lastyear", "lastmonth",
                  "yearlen", "nextyearlen", "yearordinal", "yearweekday",
@@ -1158,131 +1644,43 @@ class _iterinfo(object):
         self.rrule = rrule
 
     def rebuild(self, year, month):
-        # Every mask is 7 days longer to handle cross-year weekly periods.
+        # The tables only depend on the year, month and some of the
+        # rule's parameters. They are shared read-only by all rrules
+        # through _tables.
         rr = self.rrule
         if year != self.lastyear:
-            self.yearlen = 365 + calendar.isleap(year)
-            self.nextyearlen = 365 + calendar.isleap(year + 1)
-            firstyday = datetime.date(year, 1, 1)
-            self.yearordinal = firstyday.toordinal()
-            self.yearweekday = firstyday.weekday()
-
-            wday = datetime.date(year, 1, 1).weekday()
-            if self.yearlen == 365:
-                self.mmask = M365MASK
-                self.mdaymask = MDAY365MASK
-                self.nmdaymask = NMDAY365MASK
-                self.wdaymask = WDAYMASK[wday:]
-                self.mrange = M365RANGE
-            else:
-                self.mmask = M366MASK
-                self.mdaymask = MDAY366MASK
-                self.nmdaymask = NMDAY366MASK
-                self.wdaymask = WDAYMASK[wday:]
-                self.mrange = M366RANGE
+            (self.yearlen, self.nextyearlen, self.yearordinal,
+             self.yearweekday, self.mmask, self.mdaymask, self.nmdaymask,
+             self.wdaymask, self.mrange) = _tables.get(
+                ('year', year), _build_year_tables, year
+            )
 
             if not rr._byweekno:
                 self.wnomask = None
             else:
-                self.wnomask = [0]*(self.yearlen+7)
-                # no1wkst = firstwkst = self.wdaymask.index(rr._wkst)
-                no1wkst = firstwkst = (7-self.yearweekday+rr._wkst) % 7
-                if no1wkst >= 4:
-                    no1wkst = 0
-                    # Number of days in the year, plus the days we got
-                    # from last year.
-                    wyearlen = self.yearlen+(self.yearweekday-rr._wkst) % 7
-                else:
-                    # Number of days in the year, minus the days we
-                    # left in last year.
-                    wyearlen = self.yearlen-no1wkst
-                div, mod = divmod(wyearlen, 7)
-                numweeks = div+mod//4
-                for n in rr._byweekno:
-                    if n < 0:
-                        n += numweeks+1
-                    if not (0 < n <= numweeks):
-                        continue
-                    if n > 1:
-                        i = no1wkst+(n-1)*7
-                        if no1wkst != firstwkst:
-                            i -= 7-firstwkst
-                    else:
-                        i = no1wkst
-                    for j in range(7):
-                        self.wnomask[i] = 1
-                        i += 1
-                        if self.wdaymask[i] == rr._wkst:
-                            break
-                if 1 in rr._byweekno:
-                    # Check week number 1 of next year as well
-                    # TODO: Check -numweeks for next year.
-                    i = no1wkst+numweeks*7
-                    if no1wkst != firstwkst:
-                        i -= 7-firstwkst
-                    if i < self.yearlen:
-                        # If week starts in next year, we
-                        # don't care about it.
-                        for j in range(7):
-                            self.wnomask[i] = 1
-                            i += 1
-                            if self.wdaymask[i] == rr._wkst:
-                                break
-                if no1wkst:
-                    # Check last week number of last year as
-                    # well. If no1wkst is 0, either the year
-                    # started on week start, or week number 1
-                    # got days from last year, so there are no
-                    # days from last year's last week number in
-                    # this year.
-                    if -1 not in rr._byweekno:
-                        lyearweekday = datetime.date(year-1, 1, 1).weekday()
-                        lno1wkst = (7-lyearweekday+rr._wkst) % 7
-                        lyearlen = 365+calendar.isleap(year-1)
-                        if lno1wkst >= 4:
-                            lno1wkst = 0
-                            lnumweeks = 52+(lyearlen +
-                                            (lyearweekday-rr._wkst) % 7) % 7//4
-                        else:
-                            lnumweeks = 52+(self.yearlen-no1wkst) % 7//4
-                    else:
-                        lnumweeks = -1
-                    if lnumweeks in rr._byweekno:
-                        for i in range(no1wkst):
-                            self.wnomask[i] = 1
+                self.wnomask = _tables.get(
+                    ('weekno', year, rr._wkst, rr._byweekno),
+                    _build_wnomask, year, rr._wkst, rr._byweekno
+                )
 
         if (rr._bynweekday and (month != self.lastmonth or
                                 year != self.lastyear)):
-            ranges = []
             if rr._freq == YEARLY:
-                if rr._bymonth:
-                    for month in rr._bymonth:
-                        ranges.append(self.mrange[month-1:month+1])
-                else:
-                    ranges = [(0, self.yearlen)]
+                self.nwdaymask = _tables.get(
+                    ('nweekday', year, None, rr._bymonth, rr._bynweekday),
+                    _build_nwdaymask, year, None, rr._bymonth, rr._bynweekday
+                )
             elif rr._freq == MONTHLY:
-                ranges = [self.mrange[month-1:month+1]]
-            if ranges:
-                # Weekly frequency won't get here, so we may not
-                # care about cross-year weekly periods.
-                self.nwdaymask = [0]*self.yearlen
-                for first, last in ranges:
-                    last -= 1
-                    for wday, n in rr._bynweekday:
-                        if n < 0:
-                            i = last+(n+1)*7
-                            i -= (self.wdaymask[i]-wday) % 7
-                        else:
-                            i = first+(n-1)*7
-                            i += (7-self.wdaymask[i]+wday) % 7
-                        if first <= i <= last:
-                            self.nwdaymask[i] = 1
+                self.nwdaymask = _tables.get(
+                    ('nweekday', year, month, None, rr._bynweekday),
+                    _build_nwdaymask, year, month, None, rr._bynweekday
+                )
 
         if rr._byeaster:
-            self.eastermask = [0]*(self.yearlen+7)
-            eyday = easter.easter(year).toordinal()-self.yearordinal
-            for offset in rr._byeaster:
-                self.eastermask[eyday+offset] = 1
+            self.eastermask = _tables.get(
+                ('easter', year, rr._byeaster),
+                _build_eastermask, year, rr._byeaster
+            )
 
         self.lastyear = year
         self.lastmonth = month
@@ -218,21 +218,27 @@ def change_seq_from_hex(change_seq_hex):
     return change_seq
 
 class ChunkServer(TCPServer):
+    def __init__(self, port, path=''):
+        # Chunks are kept in path, which must be on the same
+        # filesystem as the files they are linked to.
+        self._path = path
+        super(ChunkServer, self).__init__(port)
+
     def setup(self):
         self._lock = threading.RLock()
         self._files = {}
         self._change_seq_to_fname = {}
         self._change_seq = 0
-        for fname in os.listdir("."):
+        for fname in os.listdir(self._path or "."):
             m = re.match(r"^.p2p-chunk-[a-f0-9]{16}-[a-f0-9]{64}$", fname)
             if not m:
                 continue
-            os.unlink(fname)
+            os.unlink(os.path.join(self._path, fname))
         return 8
 
     @contextmanager
     def create(self, fname):
-        tmp = tempfile.NamedTemporaryFile(dir='.', prefix='.p2p-write-')
+        tmp = tempfile.NamedTemporaryFile(dir=self._path or '.', prefix='.p2p-write-')
         try:
             yield tmp, self._change_seq + 1
             tmp.delete = False
@@ -245,10 +251,10 @@ class ChunkServer(TCPServer):
                     break
                 h.update(chunk)
             chunk_hash = h.digest()
-            chunk_fname = ".p2p-chunk-%s-%s" % (
+            chunk_fname = os.path.join(self._path, ".p2p-chunk-%s-%s" % (
                 change_seq_to_hex(self._change_seq + 1),
                 h.hexdigest(),
-            )
+            ))
             with self._lock:
                 try:
                     os.rename(tmp.name, chunk_fname)
@@ -301,7 +307,8 @@ class SyncError(Exception):
     pass
 
 class ChunkClient(object):
-    def __init__(self):
+    def __init__(self, path=''):
+        self._path = path
         self._change_seqs = {}
 
     def sync(self, pair_key, server_addr, server_port, timeout=1):
@@ -354,14 +361,14 @@ class ChunkClient(object):
             if not raw:
                 break
             chunk_change_seq, chunk_size, chunk_hash = struct.unpack(">QL32s", raw)
-            chunk_fname = '.p2p-chunk-%s-%s' % (
+            chunk_fname = os.path.join(self._path, '.p2p-chunk-%s-%s' % (
                 change_seq_to_hex(chunk_change_seq),
                 hexlify(chunk_hash),
-            )
+            ))
             if not os.path.exists(chunk_fname):
                 log("retrieving %s" % change_seq_to_hex(chunk_change_seq))
                 try:
-                    with tempfile.NamedTemporaryFile(dir='.', prefix='.p2p-transfer-') as tmp:
+                    with tempfile.NamedTemporaryFile(dir=self._path or '.', prefix='.p2p-transfer-') as tmp:
                         received_chunk_hash = receive_chunk(
                             chunk_change_seq, str(chunk_change_seq), tmp, chunk_size, chunk_size
                         )
@@ -382,11 +389,11 @@ class ChunkClient(object):
         )
 
         old_files = set()
-        for fname in os.listdir("."):
+        for fname in os.listdir(self._path or "."):
             m = re.match(r"^.p2p-chunk-[a-f0-9]{16}-[a-f0-9]{64}$", fname)
             if not m:
                 continue
-            old_files.add(fname)
+            old_files.add(os.path.join(self._path, fname))
         for fname in old_files - new_files:
             try:
                 os.unlink(fname)
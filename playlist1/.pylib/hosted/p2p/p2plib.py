@@ -35,8 +35,9 @@ VERSION = "1.0"
 
 import requests, threading, time, sys, traceback, socket, json, hmac, hashlib, struct, os
 from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
 from binascii import unhexlify, hexlify
-from collections import namedtuple
+from collections import namedtuple, deque
 
 from hosted import monotonic_time, get_random_bytes
 
@@ -52,6 +53,25 @@ P2P_GROUP_BASE_PORT = 61234
 # saved message ids.  
 MAX_MESSAGE_PER_SEC = 300
 
+# Internal messages used by the optional multicast transport.
+# See PeerGroup._announce_group_key. They are not passed to
+# on_leader_message/on_peer_message.
+MSG_GROUP_KEY = '__group_key'
+MSG_GROUP_PROBE = '__group_probe'
+MSG_GROUP_ACK = '__group_ack'
+
+# Messages sent to the same destination within COALESCE_DELAY
+# seconds are packed into a single datagram as a MSG_BATCH message.
+# A compressed batch is limited to MAX_BATCH_SIZE bytes, so the
+# resulting packet fits into a typical MTU of 1500 bytes.
+MSG_BATCH = '__batch'
+COALESCE_DELAY = 0.005
+
+# Multicast group usable as the multicast argument of PeerGroup.
+# Each peer group only receives datagrams sent to its own port.
+MULTICAST_GROUP = '239.255.61.1'
+MAX_BATCH_SIZE = 1380
+
 def log(msg, name='p2plib.py'):
     print >>sys.stderr, "[{}] {}".format(name, msg)
 
@@ -71,6 +91,79 @@ class PeerInfo(namedtuple('PeerInfo', 'ip device_id delta ping pair_key')):
             ping = self.ping,
         )
 
+def serialize(data):
+    return json.dumps(
+        data,
+        ensure_ascii=False,
+        separators=(',',':'),
+    ).encode('utf8')
+
+def encode_payload(data):
+    # The serialized and compressed message. It doesn't depend
+    # on the receiving peer, so a message sent to multiple peers
+    # is only encoded once and then sealed for each of them.
+    return serialize(data).encode('zlib')
+
+def batch_payloads(serialized):
+    # Packs consecutive serialized messages into few payloads.
+    # Batches are first formed assuming the messages compress
+    # well and split again if they don't.
+    batches, batch, size = [], [], 0
+    for data in serialized:
+        if batch and size + len(data) > MAX_BATCH_SIZE * 8:
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(data)
+        size += len(data) + 1
+    if batch:
+        batches.append(batch)
+    payloads = []
+    while batches:
+        batch = batches.pop(0)
+        if len(batch) == 1:
+            # Sent as it is, even if it exceeds MAX_BATCH_SIZE
+            payloads.append(batch[0].encode('zlib'))
+            continue
+        payload = ('{"%s":[%s]}' % (
+            MSG_BATCH, ','.join(batch)
+        )).encode('zlib')
+        if len(payload) <= MAX_BATCH_SIZE:
+            payloads.append(payload)
+        else:
+            half = len(batch) // 2
+            batches[:0] = [batch[:half], batch[half:]]
+    return payloads
+
+class PeerKey(object):
+    # Everything derived from a key that doesn't change between
+    # packets: the HMAC-SHA256 hash states after absorbing the
+    # inner and outer padded key, which are copied for each packet,
+    # and an AES cipher in ECB mode. As CBC decryption only xors
+    # each decrypted block with the previous ciphertext block, that
+    # cipher can decrypt any packet. Encryption still needs a new
+    # cipher for each packet's IV.
+    __slots__ = ('key', '_inner', '_outer', '_ecb')
+
+    def __init__(self, key):
+        self.key = key
+        padded = key.ljust(hashlib.sha256().block_size, '\0')
+        self._inner = hashlib.sha256(padded.translate(hmac.trans_36))
+        self._outer = hashlib.sha256(padded.translate(hmac.trans_5C))
+        self._ecb = AES.new(key, AES.MODE_ECB)
+
+    def mac(self, data):
+        inner = self._inner.copy()
+        inner.update(data)
+        outer = self._outer.copy()
+        outer.update(inner.digest())
+        return outer.digest()[:16]
+
+    def encrypt(self, iv, message):
+        return AES.new(self.key, AES.MODE_CBC, iv).encrypt(message)
+
+    def decrypt(self, iv, ciphertext):
+        return strxor(self._ecb.decrypt(ciphertext), iv + ciphertext[:-16])
+
 class Peer(object):
     def __init__(self, ip):
         self._ip = ip
@@ -86,13 +179,25 @@ class Peer(object):
         # MAX_MESSAGE_PER_SEC messages are sent per second.
         self._last_cleanup = 0
         self._max_msg_ids = MAX_MESSAGE_PER_SEC * self._discard_time_diff
-        self._msg_id_order = []
+        self._msg_id_order = deque()
         self._msg_id_set = set()
 
+        # Multicast state. On followers, the group key announced by
+        # this peer if it's the leader and whether any packet sealed
+        # with it was received since the last acknowledgement. On the
+        # leader, whether this peer acknowledged receiving multicast.
+        self._group_key = None
+        self._group_seen = False
+        self._multicast_ok = False
+
+        self._pair_key = None
+
     def update(self, device_id, pair_key, delta, ping, is_leader):
         log('Peer %s: %f (leader:%s)' % (device_id, ping, is_leader))
         self._device_id = device_id
-        self._pair_key = pair_key
+        if pair_key != self._pair_key:
+            self._pair_key = pair_key
+            self._pair = PeerKey(pair_key)
         self._delta = delta
         self._ping = ping
         self._is_leader = is_leader
@@ -120,16 +225,33 @@ class Peer(object):
             discard_threshold, msg_id = self._msg_id_order[0]
             if discard_threshold > now:
                 break
-            self._msg_id_order.pop(0)
+            self._msg_id_order.popleft()
             self._msg_id_set.remove(msg_id)
             deleted += 1
         # log('cleaned up %d msg ids' % (deleted,))
         self._last_cleanup = now
 
+    def set_group_key(self, group_key):
+        if self._group_key is None or group_key != self._group_key.key:
+            self._group_key = PeerKey(group_key)
+            self._group_seen = False
+
+    def pop_group_seen(self):
+        seen, self._group_seen = self._group_seen, False
+        return seen
+
     @property
     def is_leader(self):
         return self._is_leader
 
+    @property
+    def multicast_ok(self):
+        return self._multicast_ok
+
+    @multicast_ok.setter
+    def multicast_ok(self, multicast_ok):
+        self._multicast_ok = multicast_ok
+
     @property
     def device_id(self):
         return self._device_id
@@ -147,6 +269,9 @@ class Peer(object):
         return PeerInfo(self._ip, self._device_id, self._delta, self._ping, self._pair_key)
 
     def encode(self, data, direction, group_time):
+        return self.seal(encode_payload(data), direction, group_time)
+
+    def seal(self, payload, direction, group_time, key=None, msg_id=None):
         #
         # |     16      |     16      0   1           5                           x (%16=0)
         # |             |             | I | timestamp | {json message} ' <pad>  ' |
@@ -166,44 +291,40 @@ class Peer(object):
             direction << 7 | self._version, # info_bytes
             min(0xFFFFFFFF, int(group_time)),
         )
-        message += json.dumps(
-            data,
-            ensure_ascii=False,
-            separators=(',',':'),
-        ).encode('utf8').encode('zlib')
+        message += payload
         message += ' ' * (16 - (len(message)-1) % 16 - 1) # pad
-        msg_id = get_random_bytes(16)
-        cipher = AES.new(self._pair_key, AES.MODE_CBC, msg_id)
-        encrypted = msg_id + cipher.encrypt(message)
-        return hmac.HMAC(
-            self._pair_key,
-            encrypted,
-            hashlib.sha256
-        ).digest()[:16] + encrypted
+        # Copies of a message sent both using the group key and
+        # the pair key share their msg_id, so a peer receiving
+        # both of them only delivers the message once.
+        if key is None:
+            key = self._pair
+        if msg_id is None:
+            msg_id = get_random_bytes(16)
+        encrypted = msg_id + key.encrypt(msg_id, message)
+        return key.mac(encrypted) + encrypted
 
     def decode(self, pkt, expected_direction, arrival_group_time):
         mac, encrypted = pkt[:16], pkt[16:]
         if len(mac) != 16:
             # log('discarding message: invalid length (1)')
             return None
-        if hmac.HMAC(
-            self._pair_key,
-            encrypted,
-            hashlib.sha256
-        ).digest()[:16] != mac:
-            # log('discarding message: invalid signature (%d, %r)' % (
-            #     len(pkt), self._pair_key,
-            # ))
-            return None
+        key = self._pair
+        if key.mac(encrypted) != mac:
+            # Might have been sent to the whole group
+            key = self._group_key
+            if key is None or key.mac(encrypted) != mac:
+                # log('discarding message: invalid signature (%d, %r)' % (
+                #     len(pkt), self._pair_key,
+                # ))
+                return None
         msg_id, ciphertext = encrypted[:16], encrypted[16:]
         if len(msg_id) != 16:
             # log('discarding message: invalid length (2)')
             return None
-        if len(ciphertext) % 16:
+        if not ciphertext or len(ciphertext) % 16:
             # log('discarding message: invalid length (3)')
             return None
-        cipher = AES.new(self._pair_key, AES.MODE_CBC, msg_id)
-        message = cipher.decrypt(ciphertext)
+        message = key.decrypt(msg_id, ciphertext)
         hdr, data = message[:5], message[5:]
         info_byte, remote_group_time = struct.unpack("<BL", hdr)
         local_group_time = min(0xFFFFFFFF, int(arrival_group_time))
@@ -220,6 +341,10 @@ class Peer(object):
             if abs(local_group_time - remote_group_time) > self._discard_time_diff:
                 log('discarding message: outside of expected receive group time')
                 return None
+        if key is not self._pair:
+            # Multicast works, even if the message turns out to
+            # be a duplicate of its unicast copy.
+            self._group_seen = True
         if not self.add_seen_msg_id(msg_id):
             return None
         try:
@@ -231,14 +356,42 @@ class Peer(object):
     def __repr__(self):
         return '<%d: %s>' % (self._device_id, self._ip)
 
+def group_socket(port, multicast=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if multicast is not None:
+        # Allows multiple group members on the same host, for
+        # example when testing on loopback.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    if multicast is not None:
+        if 224 <= ord(socket.inet_aton(multicast)[0]) <= 239:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                socket.inet_aton(multicast) + socket.inet_aton('0.0.0.0')
+            )
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    return sock
+
 ROLE_LEADER, ROLE_FOLLOWER = 1, 2
 DIRECTION_LEADER_TO_PEER, DIRECTION_PEER_TO_LEADER = 0, 1
 
 class PeerGroup(object):
-    def __init__(self, port=None, port_offset=0, group_name=None, local_only=False):
-        # This assumed that the service is running within its node
-        # directory.
-        with open('config.json') as f:
+    def __init__(self, port=None, port_offset=0, group_name=None, local_only=False, path='', multicast=None, coalesce=None):
+        # path is the node directory relative to the working
+        # directory of the service. It defaults to the service
+        # running within its node directory.
+        #
+        # If multicast is set to a multicast group or a broadcast
+        # address, the leader sends messages to all followers that
+        # confirmed receiving them with a single datagram to that
+        # address. Others still get their own copy.
+        #
+        # If coalesce is set, messages sent within that many seconds
+        # are combined into as few datagrams as possible. Otherwise
+        # each message is sent immediately. COALESCE_DELAY works
+        # well for bursts of events.
+        with open(os.path.join(path, 'config.json')) as f:
             metadata = json.load(f)['__metadata']
 
         self._ready = threading.Event()
@@ -277,16 +430,23 @@ class PeerGroup(object):
             self._port, hexlify(self._node_scope)
         ))
 
-        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._sock.bind(('0.0.0.0', self._port))
+        self._sock = group_socket(self._port, multicast)
+        self._multicast = multicast
+        self._group_key = None
 
         self._role = None
         self._me = None
         self._leader = None
         self._peers, self._peers_lock = {}, threading.Lock()
+        self._pair_keys = {}
 
         self._group_time_base = -monotonic_time()
 
+        # Serialized messages waiting to be sent, in order, as
+        # (destination, message) tuples. See _outbox_thread.
+        self._coalesce = coalesce
+        self._outbox, self._outbox_cond = [], threading.Condition()
+
         self.setup_peer()
 
         thread = threading.Thread(target=self._update_thread)
@@ -297,6 +457,11 @@ class PeerGroup(object):
         thread.daemon = True
         thread.start()
 
+        if self._coalesce:
+            thread = threading.Thread(target=self._outbox_thread)
+            thread.daemon = True
+            thread.start()
+
     ##----- Methods to overwrite ------
 
     def setup_peer(self):
@@ -369,45 +534,33 @@ class PeerGroup(object):
     def broadcast_to_all(self, **message):
         if self._role != ROLE_LEADER:
             return
-        local_device = None
-        with self._peers_lock:
-            for ip, peer in self._peers.iteritems():
-                if peer is self._me:
-                    local_device = self._me
-                else:
-                    pkt = peer.encode(message,
-                        direction = DIRECTION_LEADER_TO_PEER,
-                        group_time = self._group_time,
-                    )
-                    try:
-                        self._sock.sendto(pkt, (ip, self._port))
-                    except socket.error:
-                        pass
+        serialized = serialize(message)
+        if self._coalesce:
+            self._queue_message(ROLE_FOLLOWER, serialized)
+        else:
+            self._send_to_followers(serialized.encode('zlib'))
+        local_device = self._me
         if local_device is not None:
             try:
-                self.on_leader_message(json.loads(json.dumps(message)), local_device.peer_info)
+                self.on_leader_message(json.loads(serialized), local_device.peer_info)
             except Exception as err:
                 traceback.print_exc()
 
     def send_to_leader(self, **message):
+        serialized = serialize(message)
         local_device = None
         with self._peers_lock:
             if self._leader is self._me:
                 local_device = self._me
-            else:
-                pkt = self._leader.encode(message,
-                    direction = DIRECTION_PEER_TO_LEADER,
-                    group_time = self._group_time,
-                )
-                try:
-                    self._sock.sendto(pkt, (self._leader.ip, self._port))
-                except socket.error:
-                    pass
         if local_device is not None:
             try:
-                self.on_peer_message(json.loads(json.dumps(message)), local_device.peer_info)
+                self.on_peer_message(json.loads(serialized), local_device.peer_info)
             except Exception as err:
                 traceback.print_exc()
+        elif self._coalesce:
+            self._queue_message(ROLE_LEADER, serialized)
+        else:
+            self._send_to_leader(serialized.encode('zlib'))
 
     ##--------------------------------
 
@@ -415,21 +568,164 @@ class PeerGroup(object):
     def _group_time(self):
         return self._group_time_base + monotonic_time()
 
+    def _queue_message(self, destination, serialized):
+        with self._outbox_cond:
+            if not self._outbox:
+                self._outbox_cond.notify()
+            self._outbox.append((destination, serialized))
+
+    def _outbox_thread(self):
+        while 1:
+            with self._outbox_cond:
+                while not self._outbox:
+                    self._outbox_cond.wait()
+            # Collect everything sent until the end of the delay
+            time.sleep(self._coalesce)
+            with self._outbox_cond:
+                outbox, self._outbox = self._outbox, []
+            try:
+                for destination, send in (
+                    (ROLE_FOLLOWER, self._send_to_followers),
+                    (ROLE_LEADER, self._send_to_leader),
+                ):
+                    if destination == ROLE_FOLLOWER and self._role != ROLE_LEADER:
+                        # Lost the leader role while the messages
+                        # were queued. _send_to_leader checks the
+                        # current leader on its own.
+                        continue
+                    for payload in batch_payloads([
+                        serialized
+                        for message_destination, serialized in outbox
+                        if message_destination == destination
+                    ]):
+                        send(payload)
+            except Exception as err:
+                traceback.print_exc()
+
+    def _send_to_followers(self, payload):
+        group_time = self._group_time
+        msg_id = get_random_bytes(16)
+        with self._peers_lock:
+            peers = self._peers.items()
+        multicast = self._send_to_group(payload, group_time, msg_id, any(
+            peer.multicast_ok for ip, peer in peers if peer is not self._me
+        ))
+        # Only the per-peer encryption and MAC remain for each
+        # peer. Neither needs the lock.
+        for ip, peer in peers:
+            if peer is self._me:
+                continue
+            elif multicast and peer.multicast_ok:
+                continue
+            else:
+                pkt = peer.seal(payload,
+                    direction = DIRECTION_LEADER_TO_PEER,
+                    group_time = group_time,
+                    msg_id = msg_id,
+                )
+                try:
+                    self._sock.sendto(pkt, (ip, self._port))
+                except socket.error:
+                    pass
+
+    def _send_to_leader(self, payload):
+        with self._peers_lock:
+            leader = self._leader
+        if leader is None or leader is self._me:
+            # Leader changed while the message was queued
+            return
+        pkt = leader.seal(payload,
+            direction = DIRECTION_PEER_TO_LEADER,
+            group_time = self._group_time,
+        )
+        try:
+            self._sock.sendto(pkt, (leader.ip, self._port))
+        except socket.error:
+            pass
+
+    def _new_group_key(self):
+        # Derived from the node scope like the pair keys. Since the
+        # node scope alone isn't secret, it's combined with a random
+        # secret only known to the leader. Followers learn the key
+        # through messages sealed with their pair key.
+        return hmac.HMAC(
+            get_random_bytes(16),
+            self._node_scope,
+            hashlib.sha256
+        ).digest()[:16]
+
+    def _send_to_group(self, payload, group_time, msg_id, needed=True):
+        group_key = self._group_key
+        if group_key is None or not needed:
+            return False
+        pkt = self._me.seal(payload,
+            direction = DIRECTION_LEADER_TO_PEER,
+            group_time = group_time,
+            key = group_key,
+            msg_id = msg_id,
+        )
+        try:
+            self._sock.sendto(pkt, (self._multicast, self._port))
+        except socket.error:
+            return False
+        return True
+
+    def _announce_group_key(self):
+        # Sends a probe to the group followed by the group key to
+        # each follower. Followers answer with whether they received
+        # anything sent to the group since their last answer, which
+        # includes the probe if multicast works. Until a follower
+        # confirms that, it gets unicast copies of all messages.
+        group_time = self._group_time
+        with self._peers_lock:
+            peers = self._peers.items()
+        self._send_to_group(encode_payload({
+            MSG_GROUP_PROBE: True,
+        }), group_time, get_random_bytes(16))
+        payload = encode_payload({
+            MSG_GROUP_KEY: hexlify(self._group_key.key),
+        })
+        for ip, peer in peers:
+            if peer is self._me:
+                continue
+            pkt = peer.seal(payload,
+                direction = DIRECTION_LEADER_TO_PEER,
+                group_time = group_time,
+            )
+            try:
+                self._sock.sendto(pkt, (ip, self._port))
+            except socket.error:
+                pass
+
+    def _on_group_message(self, message, peer):
+        if MSG_GROUP_KEY in message:
+            peer.set_group_key(unhexlify(message[MSG_GROUP_KEY]))
+            self.send_to_leader(**{
+                MSG_GROUP_ACK: peer.pop_group_seen(),
+            })
+        elif MSG_GROUP_ACK in message:
+            peer.multicast_ok = bool(message[MSG_GROUP_ACK])
+
     def _update_peers(self, peers):
         me, leader = None, None
         seen = set()
         added, deleted = set(), set()
+        # Pair keys are only derived again if they changed
+        pair_keys = {}
         with self._peers_lock:
             for idx, peer_info in enumerate(peers):
                 device_id = peer_info['device_id']
                 delta = peer_info['delta']
                 ping = peer_info['ping']
                 ip = peer_info['ip']
-                pair_key = hmac.HMAC(
-                    unhexlify(peer_info['pair_key']),
-                    self._node_scope,
-                    hashlib.sha256
-                ).digest()[:16] 
+                pair_key = self._pair_keys.get(peer_info['pair_key'])
+                if pair_key is None:
+                    pair_key = hmac.HMAC(
+                        unhexlify(peer_info['pair_key']),
+                        self._node_scope,
+                        hashlib.sha256
+                    ).digest()[:16]
+                pair_keys[peer_info['pair_key']] = pair_key
                 seen.add(ip)
                 peer = self._peers.get(ip)
                 is_added = peer is None
@@ -449,6 +745,7 @@ class PeerGroup(object):
                 # This device will always be marked by 127.0.0.1
                 if ip == '127.0.0.1':
                     me = peer
+            self._pair_keys = pair_keys
             known = set(self._peers.keys())
             for ip in known - seen:
                 log('removed peer %s' % ip)
@@ -472,6 +769,13 @@ class PeerGroup(object):
             elif self._role == ROLE_LEADER:
                 self.demote_leader()
             self._role = new_role
+            if self._multicast is not None and self._role == ROLE_LEADER:
+                self._group_key = PeerKey(self._new_group_key())
+                with self._peers_lock:
+                    for peer in self._peers.itervalues():
+                        peer.multicast_ok = False
+            else:
+                self._group_key = None
             if self._role == ROLE_FOLLOWER:
                 self.promote_follower(me.peer_info)
             elif self._role == ROLE_LEADER:
@@ -486,26 +790,44 @@ class PeerGroup(object):
                 pkt, (ip, port) = self._sock.recvfrom(2**16)
                 if port != self._port:
                     continue
-                message = receiver = None
-                with self._peers_lock:
-                    peer = self._peers.get(ip)
-                    if peer is None:
-                        continue
-                    if peer.is_leader and self._role == ROLE_FOLLOWER:
-                        receiver = self.on_leader_message
-                        message = peer.decode(pkt,
-                            expected_direction = DIRECTION_LEADER_TO_PEER,
-                            arrival_group_time = self._group_time,
-                        )
-                    elif not peer.is_leader and self._role == ROLE_LEADER:
-                        receiver = self.on_peer_message
-                        message = peer.decode(pkt,
-                            expected_direction = DIRECTION_PEER_TO_LEADER,
-                            arrival_group_time = self._group_time,
-                        )
-                    else:
-                        continue
-                if receiver and message:
+                self._on_packet(pkt, ip)
+            except Exception as err:
+                traceback.print_exc()
+
+    def _on_packet(self, pkt, ip):
+        message = receiver = None
+        with self._peers_lock:
+            peer = self._peers.get(ip)
+            if peer is None:
+                return
+            if peer.is_leader and self._role == ROLE_FOLLOWER:
+                receiver = self.on_leader_message
+                message = peer.decode(pkt,
+                    expected_direction = DIRECTION_LEADER_TO_PEER,
+                    arrival_group_time = self._group_time,
+                )
+            elif not peer.is_leader and self._role == ROLE_LEADER:
+                receiver = self.on_peer_message
+                message = peer.decode(pkt,
+                    expected_direction = DIRECTION_PEER_TO_LEADER,
+                    arrival_group_time = self._group_time,
+                )
+            else:
+                return
+        if not message:
+            return
+        if MSG_BATCH in message:
+            messages = message[MSG_BATCH]
+        else:
+            messages = [message]
+        for message in messages:
+            try:
+                if self._multicast is not None and (
+                        MSG_GROUP_KEY in message or
+                        MSG_GROUP_PROBE in message or
+                        MSG_GROUP_ACK in message):
+                    self._on_group_message(message, peer)
+                else:
                     receiver(message, peer.peer_info)
             except Exception as err:
                 traceback.print_exc()
@@ -525,6 +847,8 @@ class PeerGroup(object):
                 self._group_time_base = group_time - monotonic_time()
                 # log('group time base: %f' % (self._group_time_base,))
                 self._update_peers(peers)
+                if self._group_key is not None:
+                    self._announce_group_key()
                 self._ready.set()
             except Exception as err:
                 log('cannot update setup peers: %s' % err)
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# Tests the multicast transport of PeerGroup with a leader and
+# several followers, each with its own group socket on loopback.
+# Datagrams sent to the group go through these sockets. As all of
+# them share 127.0.0.1, unicast datagrams are handed directly to
+# the receiving member instead.
+#
+# Run from the .pylib directory:
+#
+#   python hosted/p2p/test_multicast.py [group address]
+#
+# Defaults to the loopback broadcast address 127.255.255.255.
+import sys, os, time, types, socket, threading, unittest
+from binascii import hexlify
+
+# p2plib takes its clock from the hosted module. Provide just that,
+# so the test doesn't set up a complete node.
+hosted = types.ModuleType('hosted')
+hosted.monotonic_time = time.time
+hosted.get_random_bytes = os.urandom
+sys.modules['hosted'] = hosted
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import p2plib
+
+p2plib.log = lambda msg: None
+
+GROUP = '127.255.255.255'
+
+class Member(p2plib.PeerGroup):
+    # A PeerGroup without its threads and the setup API. Peers
+    # are set with set_peers and datagrams are moved by Network.
+    def __init__(self, network, ip):
+        self._network = network
+        self._ip = ip
+        self._port = network.port
+        self._node_scope = 'node scope'
+        self._multicast = network.group
+        self._group_key = None
+        self._role = None
+        self._me = None
+        self._leader = None
+        self._peers, self._peers_lock = {}, threading.Lock()
+        self._pair_keys = {}
+        self._group_time_base = 0
+        self._coalesce = None
+        self._group_sock = p2plib.group_socket(self._port, self._multicast)
+        self._group_sock.setblocking(False)
+        self._sock = self
+        self.inbox = []
+        self.unicast = []
+        self.received = []
+        self.group_broken = False
+
+    def sendto(self, pkt, (ip, port)):
+        if ip == self._multicast:
+            self._group_sock.sendto(pkt, (ip, port))
+        else:
+            self.unicast.append(ip)
+            self._network.members[ip].inbox.append((pkt, self._ip))
+
+    def set_peers(self, ips):
+        # The first device is the leader, like in the peers/setup
+        # response. The pair key is shared by each pair of devices.
+        self._update_peers([dict(
+            device_id = int(ip.split('.')[-1]),
+            pair_key = hexlify(''.join(sorted([self._ip, ip]))[:16].ljust(16)),
+            delta = 0,
+            ping = 0,
+            ip = '127.0.0.1' if ip == self._ip else ip,
+        ) for ip in ips])
+
+    def on_leader_message(self, msg, peer_info):
+        self.received.append(msg)
+
+    def deliver(self, leader_ip):
+        delivered = False
+        while 1:
+            try:
+                pkt, addr = self._group_sock.recvfrom(2**16)
+            except socket.error:
+                break
+            delivered = True
+            if not self.group_broken and self._ip != leader_ip:
+                # Only the leader sends to the group
+                self._on_packet(pkt, leader_ip)
+        inbox, self.inbox = self.inbox, []
+        for pkt, ip in inbox:
+            self._on_packet(pkt, ip)
+        return delivered or bool(inbox)
+
+class Network(object):
+    def __init__(self, group, num_members):
+        sock = p2plib.group_socket(0, group)
+        self.port = sock.getsockname()[1]
+        self.group = group
+        self.ips = ['10.61.0.%d' % (idx+1) for idx in range(num_members)]
+        self.members = dict((ip, Member(self, ip)) for ip in self.ips)
+        sock.close()
+        self.set_leader(self.ips[0])
+
+    def set_leader(self, leader_ip):
+        self.leader_ip = leader_ip
+        ips = [leader_ip] + [ip for ip in self.ips if ip != leader_ip]
+        for member in self.members.itervalues():
+            member.set_peers(ips)
+
+    @property
+    def leader(self):
+        return self.members[self.leader_ip]
+
+    @property
+    def followers(self):
+        return [
+            member for ip, member in sorted(self.members.iteritems())
+            if ip != self.leader_ip
+        ]
+
+    def run(self):
+        # Delivers datagrams until none are left. Group datagrams
+        # need a moment on loopback.
+        time.sleep(0.05)
+        while any([
+            member.deliver(self.leader_ip)
+            for member in self.members.itervalues()
+        ]):
+            time.sleep(0.05)
+
+    def announce(self):
+        # What the leader does on every peer update cycle
+        self.leader._announce_group_key()
+        self.run()
+
+    def broadcast(self, **message):
+        # Returns the followers that got a unicast copy
+        for member in self.members.itervalues():
+            member.received = []
+        self.leader.unicast = []
+        self.leader.broadcast_to_all(**message)
+        self.run()
+        return sorted(self.leader.unicast)
+
+    def multicast_ok(self):
+        return [
+            peer.multicast_ok
+            for ip, peer in sorted(self.leader._peers.iteritems())
+            if peer is not self.leader._me
+        ]
+
+class TestMulticast(unittest.TestCase):
+    def setUp(self):
+        self.network = Network(GROUP, 3)
+
+    def tearDown(self):
+        for member in self.network.members.itervalues():
+            member._group_sock.close()
+
+    def assertReceivedOnce(self, message):
+        for member in self.network.followers:
+            self.assertEqual(member.received, [message])
+
+    def test_unicast_until_acknowledged(self):
+        network = self.network
+        self.assertEqual(network.multicast_ok(), [False, False])
+        self.assertEqual(network.broadcast(value=1), [
+            member._ip for member in network.followers
+        ])
+        self.assertReceivedOnce({'value': 1})
+
+        # The first probe is sent before the followers know the
+        # group key, so they can't acknowledge it yet.
+        network.announce()
+        self.assertEqual(network.multicast_ok(), [False, False])
+        network.announce()
+        self.assertEqual(network.multicast_ok(), [True, True])
+        self.assertEqual(network.broadcast(value=2), [])
+        self.assertReceivedOnce({'value': 2})
+
+    def test_unseen_probe_falls_back_to_unicast(self):
+        network = self.network
+        network.announce()
+        network.announce()
+        broken = network.followers[1]
+        broken.group_broken = True
+        network.announce()
+        self.assertEqual(network.multicast_ok(), [True, False])
+        self.assertEqual(network.broadcast(value=1), [broken._ip])
+        self.assertReceivedOnce({'value': 1})
+
+        # The unicast copy shares the msg_id of the group datagram,
+        # so a follower receiving both delivers the message once.
+        broken.group_broken = False
+        self.assertEqual(network.broadcast(value=2), [broken._ip])
+        self.assertReceivedOnce({'value': 2})
+
+        network.announce()
+        self.assertEqual(network.multicast_ok(), [True, True])
+
+    def test_key_rotation(self):
+        network = self.network
+        network.announce()
+        network.announce()
+        old_leader = network.leader
+        old_key = old_leader._group_key.key
+
+        # A new leader uses a new group key. Until the followers
+        # acknowledged receiving datagrams sealed with it, they
+        # get unicast copies again.
+        network.set_leader(network.ips[1])
+        self.assertEqual(old_leader._group_key, None)
+        self.assertNotEqual(network.leader._group_key.key, old_key)
+        self.assertEqual(network.multicast_ok(), [False, False])
+        self.assertEqual(network.broadcast(value=1), [
+            member._ip for member in network.followers
+        ])
+        self.assertReceivedOnce({'value': 1})
+
+        network.announce()
+        network.announce()
+        self.assertEqual(network.multicast_ok(), [True, True])
+        self.assertEqual(network.broadcast(value=2), [])
+        self.assertReceivedOnce({'value': 2})
+
+        # Datagrams sealed with the previous leader's key are
+        # rejected.
+        follower = network.followers[1]
+        leader_peer = follower._peers[network.leader_ip]
+        pkt = leader_peer.seal(p2plib.encode_payload({'value': 3}),
+            direction = p2plib.DIRECTION_LEADER_TO_PEER,
+            group_time = follower._group_time,
+            key = p2plib.PeerKey(old_key),
+        )
+        follower._on_packet(pkt, network.leader_ip)
+        self.assertEqual(follower.received, [{'value': 2}])
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        GROUP = sys.argv.pop(1)
+    unittest.main()
@@ -1,5 +1,6 @@
 from __future__ import print_function
-import datetime, traceback
+import datetime, traceback, json, weakref
+from bisect import bisect_left, bisect_right
 from calendar import timegm, monthrange
 from six import integer_types, string_types
 
@@ -512,7 +513,7 @@ SUPPORTED_TIMEZONES = set([
 def dt_to_unix(dt):
     return timegm(dt.timetuple())
 def utc_to_local(utc_dt, tz):
-    return pytz.utc.localize(utc_dt).astimezone(tz).replace(tzinfo=None)
+    return _tz_year(tz, utc_dt.year).utc_to_local(utc_dt)
 def local_to_utc(local_dt):
     return local_dt.astimezone(pytz.utc).replace(tzinfo=None)
 
@@ -524,6 +525,85 @@ def _omit_none(d):
 
 DAY_MINUTES = 24 * 60
 
+# TimeSpec.next_transition looks for span boundaries in
+# windows of this size and gives up after the given limit.
+TRANSITION_PROBE_WINDOW = datetime.timedelta(days=7)
+TRANSITION_PROBE_LIMIT = datetime.timedelta(days=366)
+
+ZERO = datetime.timedelta(0)
+
+class TzYear(object):
+    """
+    UTC offsets of a timezone around one year: transitions[i] is the
+    UTC time at which offsets[i+1] replaces offsets[i]. Usually there
+    are at most two transitions, so lookups are cheaper than going
+    through pytz, which creates tzinfo objects for each conversion.
+    """
+    __slots__ = ('transitions', 'offsets')
+
+    def __init__(self, tz, year):
+        utc_times = getattr(tz, '_utc_transition_times', None)
+        if not utc_times:
+            self.transitions = ()
+            self.offsets = (tz.utcoffset(datetime.datetime(year, 1, 1)),)
+            return
+        # Include the surrounding days, so local times in this year
+        # are covered regardless of their offset.
+        if year > datetime.MINYEAR:
+            first = datetime.datetime(year - 1, 12, 30)
+        else:
+            first = datetime.datetime.min
+        if year < datetime.MAXYEAR:
+            last = datetime.datetime(year + 1, 1, 3)
+        else:
+            last = datetime.datetime.max
+        first = bisect_right(utc_times, first)
+        last = bisect_right(utc_times, last)
+        self.transitions = tuple(utc_times[first:last])
+        self.offsets = tuple(
+            tz._transition_info[max(idx, 0)][0]
+            for idx in range(first - 1, last)
+        )
+
+    def utc_to_local(self, utc_dt):
+        return utc_dt + self.offsets[bisect_right(self.transitions, utc_dt)]
+
+    def gaps(self):
+        """
+        Yields (start, skipped) for each range of local times skipped
+        by a transition.
+        """
+        offsets = self.offsets
+        for idx, utc_dt in enumerate(self.transitions):
+            skipped = offsets[idx + 1] - offsets[idx]
+            if skipped > ZERO:
+                yield utc_dt + offsets[idx], skipped
+
+    def normalize(self, dt_naive_local):
+        """
+        Returns the local time dt_naive_local refers to. That's the
+        time itself unless it's skipped by a transition. Those are
+        moved forward by the skipped duration, same as localizing
+        with schedule_localize and converting back.
+        """
+        for gap_start, skipped in self.gaps():
+            if gap_start <= dt_naive_local < gap_start + skipped:
+                return dt_naive_local + skipped
+        return dt_naive_local
+
+# TzYear instances by (zone, year).
+_tz_years = {}
+
+def _tz_year(tz, year):
+    key = tz.zone, year
+    tz_year = _tz_years.get(key)
+    if tz_year is None:
+        tz_year = _tz_years[key] = TzYear(tz, year)
+    return tz_year
+
+def normalize_local(tz, dt_naive_local):
+    return _tz_year(tz, dt_naive_local.year).normalize(dt_naive_local)
+
 def schedule_localize(tz, dt_local):
     try:
         return tz.localize(dt_local, is_dst=None)
@@ -540,6 +620,24 @@ def schedule_localize(tz, dt_local):
             tz.localize(dt_local, is_dst=False),
         )
 
+def probe_grid(start, step, count):
+    """
+    Returns `count` probe times starting at `start`, `step` apart,
+    for use with is_active_at_many. Works for both unix timestamps
+    and naive local datetimes with a timedelta step.
+    """
+    return [start + step * idx for idx in range(count)]
+
+def _merge_spans(spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
 class TimeSpecError(Exception):
     pass
 
@@ -554,27 +652,53 @@ def verified_timezone(timezone):
         raise TimeSpecError("Unknown timezone")
     return tz
 
+# TimeSpecs created from configs, keyed by their canonical spec.
+# Identical schedules share one TimeSpec and the caches of its rrule
+# for as long as any parsed config still references it. This includes
+# reparsing a config, as the previous one is only released after that.
+_timespecs = weakref.WeakValueDictionary()
+
+def _spec_key(spec):
+    return json.dumps(spec, sort_keys=True)
+
 def timespec_from_config(value):
     if value == 'always':
         return AlwaysSpec()
     elif value == 'never':
         return NeverSpec()
-    else:
-        return TimeSpec.from_trusted_spec(value)
+    key = _spec_key(value)
+    timespec = _timespecs.get(key)
+    if timespec is None:
+        timespec = TimeSpec.from_trusted_spec(value)
+        # Equivalent specs written differently end up with the
+        # TimeSpec interned under their serialized form.
+        timespec = _timespecs.setdefault(
+            _spec_key(timespec.serialize()), timespec
+        )
+        _timespecs[key] = timespec
+    return timespec
 
 class AlwaysSpec(object):
     def is_active_at(self, tz, dt_naive_local):
         return True
+    def is_active_at_many(self, tz, dt_naive_locals):
+        return bytearray([1]) * len(dt_naive_locals)
     def spans_between(self, tz, dt_naive_local_min, dt_naive_local_max):
         return [(dt_naive_local_min, dt_naive_local_max)]
+    def next_transition(self, tz, dt_naive_local):
+        return None
     def serialize(self):
         return 'always'
 
 class NeverSpec(object):
     def is_active_at(self, tz, dt_naive_local):
         return False
+    def is_active_at_many(self, tz, dt_naive_locals):
+        return bytearray(len(dt_naive_locals))
     def spans_between(self, tz, dt_naive_local_min, dt_naive_local_max):
         return []
+    def next_transition(self, tz, dt_naive_local):
+        return None
     def serialize(self):
         return 'never'
 
@@ -882,6 +1006,7 @@ class TimeSpec(object):
                 byweekno = self._by_weekno,
                 bysetpos = self._by_setpos,
                 max_year = self._start.year + 25,
+                window_cache = True,
             )
         except Exception as err:
             traceback.print_exc()
@@ -998,16 +1123,8 @@ class TimeSpec(object):
                 continue
             # print('naive: ', dt_naive_local_span_min, dt_naive_local_span_max)
 
-            dt_local_span_min = schedule_localize(tz, dt_naive_local_span_min).astimezone(tz)
-            dt_local_span_max = schedule_localize(tz, dt_naive_local_span_max).astimezone(tz)
-
-            # print('local: ', dt_local_span_min, dt_local_span_max)
-            # unix_min = dt_to_unix(dt_local_span_min.astimezone(pytz.UTC))
-            # unix_max = dt_to_unix(dt_local_span_max.astimezone(pytz.UTC))
-            # print('unix: ', unix_min, unix_max, '|||||', (unix_max - unix_min) / 60)
-
-            dt_naive_local_span_min = dt_local_span_min.replace(tzinfo=None)
-            dt_naive_local_span_max = dt_local_span_max.replace(tzinfo=None)
+            dt_naive_local_span_min = normalize_local(tz, dt_naive_local_span_min)
+            dt_naive_local_span_max = normalize_local(tz, dt_naive_local_span_max)
 
             # Apply clipping
             if earliest is not None:
@@ -1077,6 +1194,63 @@ class TimeSpec(object):
             tz, dt_naive_local, dt_naive_local + datetime.timedelta(seconds=1)
         ))
 
+    def is_active_at_many(self, tz, dt_naive_locals):
+        """
+        Returns a bytearray with the result of is_active_at for each
+        of the sorted dt_naive_locals. The probes are merged with the
+        spans between the first and last probe in a single pass.
+        """
+        active = bytearray(len(dt_naive_locals))
+        if not dt_naive_locals:
+            return active
+        second = datetime.timedelta(seconds=1)
+        first, last = dt_naive_locals[0], dt_naive_locals[-1] + second
+        spans = _merge_spans(self.spans_between(tz, first, last))
+        idx = 0
+        for pos, dt_naive_local in enumerate(dt_naive_locals):
+            while idx < len(spans) and spans[idx][1] <= dt_naive_local:
+                idx += 1
+            if idx == len(spans):
+                break
+            if spans[idx][0] < dt_naive_local + second:
+                active[pos] = 1
+
+        # is_active_at clips spans to the probed second before moving
+        # times skipped by a DST transition, so spans starting or ending
+        # within skipped times might give different results around
+        # them. Those few probes are evaluated individually.
+        for year in range(first.year, last.year + 1):
+            for gap_start, skipped in _tz_year(tz, year).gaps():
+                for pos in range(
+                    bisect_left(dt_naive_locals, gap_start - second),
+                    bisect_left(dt_naive_locals, gap_start + 2 * skipped + second),
+                ):
+                    active[pos] = self.is_active_at(tz, dt_naive_locals[pos])
+        return active
+
+    def next_transition(self, tz, dt_naive_local):
+        # Returns the first span boundary after dt_naive_local, so
+        # the earliest time is_active_at might change its result.
+        # Returns None once the schedule is exhausted and the
+        # probe limit if no boundary is found until then.
+        limit = dt_naive_local + TRANSITION_PROBE_LIMIT
+        probe = dt_naive_local
+        while probe < limit:
+            if self.is_exhausted_on(tz, probe):
+                return None
+            window_max = probe + TRANSITION_PROBE_WINDOW
+            # Span boundaries are minute aligned. Starting the window
+            # a minute early detects a span starting right at the
+            # probe while ignoring the artificial boundaries created
+            # by clipping spans to the window.
+            window_min = probe - datetime.timedelta(minutes=1)
+            for span in self.spans_between(tz, window_min, window_max):
+                for boundary in span:
+                    if window_min < boundary < window_max and boundary > dt_naive_local:
+                        return boundary
+            probe = window_max
+        return limit
+
     def spans_between(self, tz, dt_naive_local_min, dt_naive_local_max):
         if dt_naive_local_min >= dt_naive_local_max:
             return []
@@ -1118,4 +1292,151 @@ if __name__ == "__main__":
             for timezone in SUPPORTED_TIMEZONES:
                 pytz.timezone(timezone)
 
+    class TestTzYear(unittest.TestCase):
+        def test_matches_pytz(self):
+            for timezone in ('Europe/Berlin', 'America/New_York',
+                    'Australia/Lord_Howe', 'Asia/Tokyo', 'UTC'):
+                tz = pytz.timezone(timezone)
+                probe = datetime.datetime(2023, 1, 1)
+                while probe.year < 2025:
+                    self.assertEqual(utc_to_local(probe, tz),
+                        pytz.utc.localize(probe).astimezone(tz).replace(tzinfo=None))
+                    self.assertEqual(normalize_local(tz, probe),
+                        schedule_localize(tz, probe).astimezone(tz).replace(tzinfo=None))
+                    probe += datetime.timedelta(minutes=53)
+
+    class TestActiveAtMany(unittest.TestCase):
+        def test_matches_is_active_at(self):
+            tz = pytz.timezone('Europe/Berlin')
+            for spec in (
+                dict(start='2024-03-04 09:15', spans=[[60, 150], [150, 900]],
+                    repeat=dict(freq='weekly', by_weekday=[0, 2, 6])),
+                dict(start='2024-03-01', spans=[[90, 200], [1380, 1500]],
+                    repeat=dict(freq='daily', until='2024-04-02 13:30')),
+            ):
+                timespec = timespec_from_config(spec)
+                for start, step in (
+                    (datetime.datetime(2024, 2, 28, 23, 59, 30),
+                        datetime.timedelta(minutes=7, seconds=1)),
+                    (datetime.datetime(2024, 3, 31, 1, 59, 58),
+                        datetime.timedelta(seconds=1, microseconds=500000)),
+                ):
+                    probes = probe_grid(start, step, 6000)
+                    self.assertEqual(
+                        list(timespec.is_active_at_many(tz, probes)),
+                        [int(timespec.is_active_at(tz, dt)) for dt in probes],
+                    )
+
+    class TestRRuleSeek(unittest.TestCase):
+        def assertSeekMatches(self, **kwargs):
+            full = list(rrule.rrule(**kwargs))
+            probe = kwargs['dtstart']
+            while probe.year <= kwargs['max_year']:
+                window = probe + datetime.timedelta(days=9)
+                self.assertEqual(
+                    rrule.rrule(**kwargs).between(probe, window, inc=True),
+                    [dt for dt in full if probe <= dt <= window],
+                )
+                probe += datetime.timedelta(days=37, hours=5)
+
+        def test_seek(self):
+            start = datetime.datetime(2019, 3, 13)
+            for freq in (rrule.DAILY, rrule.WEEKLY, rrule.MONTHLY):
+                self.assertSeekMatches(freq=freq, dtstart=start, interval=3,
+                    max_year=2022)
+                self.assertSeekMatches(freq=freq, dtstart=start, count=150,
+                    byweekday=[rrule.MO, rrule.FR], max_year=2022)
+                self.assertSeekMatches(freq=freq, dtstart=start, interval=2,
+                    until=datetime.datetime(2021, 5, 1), max_year=2022)
+
+        def test_window_cache(self):
+            start = datetime.datetime(2019, 3, 13, 8, 30)
+            for kwargs in (
+                dict(freq=rrule.DAILY, interval=3),
+                dict(freq=rrule.WEEKLY, count=40, byweekday=[rrule.MO, rrule.FR]),
+                dict(freq=rrule.MONTHLY, until=datetime.datetime(2020, 5, 1)),
+            ):
+                plain = rrule.rrule(dtstart=start, max_year=2022, **kwargs)
+                cached = rrule.rrule(dtstart=start, max_year=2022,
+                    window_cache=True, **kwargs)
+                probe = start - datetime.timedelta(days=20)
+                while probe.year <= 2022:
+                    for dt in (probe, probe + datetime.timedelta(days=2), probe):
+                        window = dt + datetime.timedelta(days=9)
+                        self.assertEqual(
+                            cached.between(dt, window, inc=True),
+                            plain.between(dt, window, inc=True),
+                        )
+                        self.assertEqual(
+                            list(cached.xafter(dt, count=2, inc=True)),
+                            list(plain.xafter(dt, count=2, inc=True)),
+                        )
+                        self.assertEqual(dt in cached, dt in plain)
+                    self.assertTrue(len(cached._windows) <= rrule.MAX_CACHED_WINDOWS)
+                    probe += datetime.timedelta(days=5, hours=7)
+
+    class TestTimeSpecIntern(unittest.TestCase):
+        def test_intern(self):
+            spec = dict(start='2020-03-04', spans=[[60, 120]],
+                repeat=dict(freq='weekly', by_weekday=[0, 2]))
+            timespec = timespec_from_config(spec)
+            self.assertIs(timespec_from_config(json.loads(json.dumps(spec))), timespec)
+            self.assertIs(timespec_from_config(
+                dict(spec, repeat=dict(spec['repeat'], interval=1))
+            ), timespec)
+            self.assertIsNot(timespec_from_config(
+                dict(spec, spans=[[60, 180]])
+            ), timespec)
+            ref = weakref.ref(timespec)
+            del timespec
+            self.assertIsNone(ref())
+            self.assertEqual(len(_timespecs), 0)
+
+    class TestRRuleSimple(unittest.TestCase):
+        def test_random_rules(self):
+            import bisect, random
+            rnd = random.Random(1)
+            for _ in range(400):
+                start = datetime.datetime(2019, 12, rnd.randint(1, 31),
+                    rnd.randint(0, 23), rnd.choice((0, 30)))
+                kwargs = dict(
+                    freq = rnd.choice((rrule.DAILY, rrule.WEEKLY)),
+                    dtstart = start,
+                    interval = rnd.randint(1, 5),
+                    wkst = rnd.randint(0, 6),
+                    max_year = start.year + rnd.randint(0, 1),
+                )
+                if rnd.random() < 0.7:
+                    kwargs['byweekday'] = rnd.sample(range(7), rnd.randint(1, 7))
+                if rnd.random() < 0.2:
+                    kwargs['byhour'] = rnd.sample(range(24), rnd.randint(1, 3))
+                limit = rnd.random()
+                if limit < 0.3:
+                    kwargs['count'] = rnd.randint(0, 200)
+                elif limit < 0.6:
+                    kwargs['until'] = start + datetime.timedelta(
+                        days=rnd.randint(-2, 400), hours=rnd.randint(0, 23))
+                rule = rrule.rrule(**kwargs)
+                if rule._simple is None:
+                    continue
+                full = list(iter(rule))
+                probes = full[::7] + [
+                    start + datetime.timedelta(minutes=rnd.randint(-5000, 800000))
+                    for _ in range(30)
+                ]
+                for dt in probes:
+                    lo = bisect.bisect_left(full, dt)
+                    hi = bisect.bisect_right(full, dt)
+                    self.assertEqual(dt in rule, lo != hi)
+                    self.assertEqual(rule.after(dt),
+                        full[hi] if hi < len(full) else None)
+                    self.assertEqual(rule.after(dt, inc=True),
+                        full[lo] if lo < len(full) else None)
+                    self.assertEqual(rule.before(dt),
+                        full[lo - 1] if lo else None)
+                    self.assertEqual(rule.before(dt, inc=True),
+                        full[hi - 1] if hi else None)
+                    self.assertEqual(list(rule.xafter(dt, count=3)),
+                        full[hi:hi + 3])
+
     unittest.main()
@@ -1,13 +1,14 @@
-import random, time, threading
-from itertools import count
-from collections import namedtuple, defaultdict
+import os, random, time, threading, json
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, defaultdict, OrderedDict
 
 from player_plugin import (
     log, sleep_until, start_worker,
-    local_time, tv_power,
-    synced_lua_call,
-    common_config, local_config,
-    Plugin, rpc_call
+    local_time, wall_time, tv_power,
+    synced_lua_call, synced_lua_calls, synced_call, synced_json,
+    local_lua_call, local_tv_power, is_leader,
+    common_config, local_config, watch_config, node_path,
+    get_peers, Plugin, rpc_call
 )
 
 PRELOAD = 1
@@ -15,6 +16,46 @@ MAX_SUSPEND_DEPTH = 4
 
 INTERRUPT_PRELOAD = 0.5
 
+# How far ahead the active slot index is precomputed
+SLOT_INDEX_HORIZON = 6 * 3600
+
+# While idle, check for config changes that often
+IDLE_CONFIG_CHECK = 2
+
+# While idle, send the fallback and display power state again
+# that often, so devices that joined in the meantime get it.
+IDLE_RESEND = 60
+
+# Number of recently seen configs for which derived
+# playlist data is kept around.
+MAX_COMPILED_CONFIGS = 5
+
+# Playout plan mode: The leader plans PLAN_HORIZON seconds
+# ahead and extends the plan once less than PLAN_REFILL
+# seconds remain. Items switching less than PLAN_START_MARGIN
+# seconds after a plan is synced to all devices are still
+# sent as events. Items preloading within PLAN_CUT_LEAD
+# seconds are no longer revised. The running plan is announced
+# again every PLAN_ANNOUNCE seconds for restarted followers.
+# Peers joining the group get it synced again.
+PLAN_FILE = 'playout-plan.json'
+PLAN_HORIZON = 3600
+PLAN_REFILL = 600
+PLAN_MAX_ITEMS = 1000
+PLAN_START_MARGIN = 2
+PLAN_CUT_LEAD = 0.5
+PLAN_SYNC_TIMEOUT = 30
+PLAN_ANNOUNCE = 10
+
+# Lock-step dual output: If enabled on both outputs, the
+# scheduler of the first output decides items for both and
+# switches them using shared events.
+DUAL_OUTPUTS = ('playlist1', 'playlist2')
+
+# Items of both outputs ending that close together switch
+# at the same time.
+SWITCH_TOLERANCE = 0.01
+
 Item = namedtuple(
     "Item",
     "config_hash item_idx duration cnt rnd ovr"
@@ -31,28 +72,277 @@ FALLBACK_ITEM = Item( # will trigger fallback on lua display
 
 class AlternativeLooper(object):
     def __init__(self):
-        self._count = count(0).next
+        self._count = 0
     def next(self):
-        return self._count() % (1*2*3*4*5*6*7*8*9*10)
+        cnt = self._count % (1*2*3*4*5*6*7*8*9*10)
+        self._count += 1
+        return cnt
+    def rewind(self):
+        self._count -= 1
+
+PlanEntry = namedtuple(
+    "PlanEntry",
+    "switch item tv_on"
+)
+
+class PlannedItem(object):
+    # An item planned by the leader. Once it's part of a plan
+    # synced to all devices, they switch to it on their own.
+    # Otherwise it's dispatched as preload/switch events.
+    __slots__ = (
+        'switch', 'item', 'tv_on', 'state', 'generated',
+        'by_plan', 'dispatched',
+    )
+
+    def __init__(self, switch, item, tv_on, state, generated):
+        self.switch = switch
+        self.item = item
+        self.tv_on = tv_on
+        self.state = state
+        self.generated = generated
+        self.by_plan = False
+        self.dispatched = False
 
 TagFilter= namedtuple(
     "TagFilter",
     "selector cycles"
 )
 
-def match_selector(selector, tags):
-    log("match filter: %r %r" % (selector, tags))
-    if isinstance(selector, unicode):
-        return selector in tags
-    elif isinstance(selector, list):
-        return any(
-            set(tag_set).issubset(tags)
-            for tag_set in selector
+def compile_selector(selectors):
+    # A selector matches a slot if all tags of any of its
+    # tag sets are present. Duplicate tag sets are dropped
+    # and the result is hashable, so it can be used as a
+    # cache key by the TagIndex.
+    return tuple(set(frozenset(tags) for tags in selectors))
+
+class Slot(object):
+    # Values of a playlist slot as used by the ItemGenerator,
+    # derived once from the parsed config.
+    __slots__ = ('schedule', 'duration', 'slot_type', 'tags')
+
+    def __init__(self, item):
+        self.schedule = item['schedule']
+
+        duration = item['duration']
+        if duration == 0: # auto duration?
+            duration = 10
+            metadata = item['asset']['metadata']
+            if 'duration' in metadata:
+                duration = metadata['duration']
+
+        # Ensure there's at least a small gap between
+        # the end of playback of the previous item and
+        # the preloading of the next one.
+        self.duration = max(PRELOAD + 1, duration)
+
+        self.slot_type = item.get('slot_type')
+        self.tags = set(item['asset']['tags']) | (
+            set(item['extra_tags'].split(','))
+            if 'extra_tags' in item else set()
+        )
+
+class TagIndex(object):
+    """
+    Tag vocabulary of a playlist. The tags of each slot are
+    kept as a bitset over the vocabulary and each tag has a
+    posting list of the slots using it. A compiled selector
+    resolves to a bitmask of all matching slots, which is
+    cached until the playlist config changes.
+    """
+    def __init__(self, slots):
+        self._tag_bits = {}
+        self._postings = defaultdict(list)
+        self._slot_bits = []
+        for item_idx, slot in enumerate(slots):
+            bits = 0
+            for tag in slot.tags:
+                bits |= self._tag_bits.setdefault(tag, 1 << len(self._tag_bits))
+                self._postings[tag].append(item_idx)
+            self._slot_bits.append(bits)
+        self._all_slots = (1 << len(slots)) - 1
+        self._matching = {}
+
+    def matching(self, selector):
+        matching = self._matching.get(selector)
+        if matching is None:
+            matching = 0
+            for tag_set in selector:
+                if not tag_set:
+                    matching = self._all_slots
+                    break
+                if not all(tag in self._tag_bits for tag in tag_set):
+                    continue
+                mask = 0
+                for tag in tag_set:
+                    mask |= self._tag_bits[tag]
+                # Only slots in the shortest posting list can
+                # have all the tags.
+                for item_idx in min(
+                    (self._postings[tag] for tag in tag_set), key=len
+                ):
+                    if self._slot_bits[item_idx] & mask == mask:
+                        matching |= 1 << item_idx
+            self._matching[selector] = matching
+        return matching
+
+class OverlayIndex(object):
+    """
+    Overlay groups of a config compiled by slot type. Those
+    conditions not handled here are decided within the Lua
+    code on each individual display as they depend on the base
+    asset playing. As that depends on the device, it cannot be
+    decided here.
+
+    For each slot type the list of potential overlay groups is
+    kept until the next transition of any schedule condition
+    involved.
+    """
+    def __init__(self, overlay_groups):
+        self._groups = []
+        for overlay_group in overlay_groups:
+            slot_types, excluded, schedules = set(), set(), []
+            for condition in overlay_group.get('conditions', ()):
+                condition_type = condition['condition_type']
+                if condition_type == 'schedule':
+                    schedules.append(condition['schedule'])
+                elif condition_type == 'slot_type':
+                    slot_types.add(condition['slot_type'])
+                elif condition_type == 'not_slot_type':
+                    excluded.add(condition['slot_type'])
+            self._groups.append((
+                overlay_group['_id'], slot_types, excluded, schedules
+            ))
+        self._by_slot_type = {}
+        self._potential = {}
+
+    def groups_for(self, slot_type):
+        groups = self._by_slot_type.get(slot_type)
+        if groups is None:
+            groups = self._by_slot_type[slot_type] = [
+                (overlay_group_id, schedules)
+                for overlay_group_id, slot_types, excluded, schedules
+                in self._groups
+                if slot_types <= set([slot_type]) and
+                   slot_type not in excluded
+            ]
+        return groups
+
+    def potential(self, slot_type, now):
+        cached = self._potential.get(slot_type)
+        if cached is not None:
+            valid_from, valid_until, potential_overlay_groups = cached
+            if valid_from <= now < valid_until:
+                return potential_overlay_groups
+        potential_overlay_groups = []
+        valid_until = float('inf')
+        for overlay_group_id, schedules in self.groups_for(slot_type):
+            if all(schedule.is_active_at(now) for schedule in schedules):
+                potential_overlay_groups.append(overlay_group_id)
+            for schedule in schedules:
+                transition = schedule.next_transition(now)
+                if transition is not None:
+                    valid_until = min(valid_until, transition)
+        self._potential[slot_type] = (
+            now, valid_until, potential_overlay_groups
         )
-    return False
+        return potential_overlay_groups
+
+class ActiveSlotIndex(object):
+    """
+    Splits the time between `now` and the index horizon into
+    ranges in which the set of active playlist slots doesn't
+    change. For each range the sorted list of active slot
+    indices is precomputed, so finding the next playable slot
+    doesn't have to probe every schedule.
+    """
+    def __init__(self, config_hash, slots, now):
+        self.valid_from = now
+        self.valid_until = now + SLOT_INDEX_HORIZON
+
+        slot_spans = []
+        transitions = set()
+        for slot in slots:
+            spans = []
+            schedule = slot.schedule
+            t = since = now
+            active = schedule.is_active_at(now)
+            while t < self.valid_until:
+                # Only transitions that flip the slot's activity
+                # become boundaries. Stop once the schedule doesn't
+                # change anymore, like after the end of the range of
+                # expanded schedules.
+                t = schedule.next_transition(t)
+                if t is None or t >= self.valid_until:
+                    t = self.valid_until
+                elif schedule.is_active_at(t) == active:
+                    continue
+                else:
+                    transitions.add(t)
+                if active:
+                    spans.append((since, t))
+                since, active = t, not active
+            slot_spans.append(spans)
+
+        self._boundaries = [now] + sorted(transitions)
+        self._active = [[] for boundary in self._boundaries]
+        for item_idx, spans in enumerate(slot_spans):
+            for start, end in spans:
+                for idx in xrange(
+                    bisect_left(self._boundaries, start),
+                    bisect_left(self._boundaries, end),
+                ):
+                    self._active[idx].append(item_idx)
+        log("slot index for %s: %d transitions until %s" % (
+            config_hash, len(transitions), time.ctime(self.valid_until),
+        ))
+
+    def covers(self, now):
+        return self.valid_from <= now < self.valid_until
+
+    def active_at(self, now):
+        return self._active[bisect_right(self._boundaries, now) - 1]
+
+    def next_activation(self, now):
+        # Earliest time a slot is active after the range containing
+        # `now`. If there is none within the horizon, return the
+        # end of the horizon, so the index gets rebuilt.
+        for idx in xrange(
+            bisect_right(self._boundaries, now), len(self._boundaries)
+        ):
+            if self._active[idx]:
+                return self._boundaries[idx]
+        return self.valid_until
+
+    def next_transition(self, now):
+        # Start of the range following the one containing `now`
+        idx = bisect_right(self._boundaries, now)
+        if idx < len(self._boundaries):
+            return self._boundaries[idx]
+        return self.valid_until
+
+class CompiledConfig(object):
+    """
+    Everything the ItemGenerator derives from a parsed config,
+    built once per config hash.
+    """
+    def __init__(self, config):
+        self.config_hash = config.config_hash
+        self.slots = [Slot(item) for item in config.playlist]
+        self.tag_index = TagIndex(self.slots)
+        self.overlay_index = OverlayIndex(config.overlay_groups)
+        self._slot_index = None
+
+    def slot_index(self, now):
+        if self._slot_index is None or not self._slot_index.covers(now):
+            self._slot_index = ActiveSlotIndex(
+                self.config_hash, self.slots, now
+            )
+        return self._slot_index
 
 class ItemGenerator(object):
-    def __init__(self):
+    def __init__(self, config_source=common_config):
+        self._config_source = config_source
+
         # zero-indexed offset into the playlist. Start
         # with -1 so the initial item after incrementing
         # is item 0.
@@ -62,6 +352,12 @@ class ItemGenerator(object):
         self._tag_filters = []
         self._tag_filter_cycle = 0
 
+        self._compiled = OrderedDict()
+
+        # Last item returned by get_next, even if it
+        # then got replaced by the fallback.
+        self.last_item = None
+
     def reset_tag_filter(self):
         self._tag_filters = []
         self._tag_filter_cycle = 0
@@ -70,109 +366,296 @@ class ItemGenerator(object):
         log('appended tag filter: %r' % (tag_filter,))
         self._tag_filters.append(tag_filter)
 
-    def get_next(self):
-        config = common_config()
+    def on_wrap(self):
+        # At start of playlist with filters: See if filter expires
+        if self._tag_filters:
+            self._tag_filter_cycle += 1
+            log("next round. tag filter cycle %d" % self._tag_filter_cycle)
+            max_cycles = self._tag_filters[0].cycles
+            if max_cycles is not None and self._tag_filter_cycle > max_cycles:
+                self._tag_filters.pop(0)
+
+    def compiled(self, config):
+        # Least recently used configs are evicted first, so the
+        # one in use stays compiled.
+        compiled = self._compiled.pop(config.config_hash, None)
+        if compiled is None:
+            compiled = CompiledConfig(config)
+        self._compiled[config.config_hash] = compiled
+        while len(self._compiled) > MAX_COMPILED_CONFIGS:
+            self._compiled.popitem(last=False)
+        return compiled
+
+    def first_playable(self, compiled, slots):
+        # First of the given slots matching the current tag filter
+        if not self._tag_filters:
+            return slots[0] if slots else None
+        matching = compiled.tag_index.matching(
+            self._tag_filters[0].selector
+        )
+        for item_idx in slots:
+            if matching >> item_idx & 1:
+                return item_idx
+        return None
+
+    def save(self):
+        return self._item_idx, list(self._tag_filters), self._tag_filter_cycle
+
+    def restore(self, state):
+        self._item_idx, tag_filters, self._tag_filter_cycle = state
+        self._tag_filters = list(tag_filters)
+
+    def rewind(self, item):
+        # Undo the alternative counting done for a returned item
+        self._item_idx_count[item.item_idx-1].rewind()
+
+    def next_activation(self, now=None):
+        """
+        Returns the unix time at which get_next should be called
+        again after it didn't find a playable item, or None if
+        there's no playlist at all. If slots are active right now
+        but excluded by tag filters, the result only changes once
+        the set of active slots changes or the filters change. A
+        filter with a cycle limit counts each fallback round as a
+        cycle, so until it expires, the fallback duration is
+        returned.
+        """
+        config = self._config_source()
+        if config is None or not config.playlist:
+            return None
+        if now is None:
+            now = time.time()
+        index = self.compiled(config).slot_index(now)
+        if index.active_at(now):
+            if self._tag_filters and self._tag_filters[0].cycles is not None:
+                return now + FALLBACK_ITEM.duration
+            return index.next_transition(now)
+        return index.next_activation(now)
+
+    def get_next(self, now=None):
+        self.last_item = None
+        config = self._config_source()
         if config is None:
             log("no common config")
             return None
 
-        now = time.time()
+        if now is None:
+            now = time.time()
 
         # find next playable item within the common playlist
-        playlist = config.playlist
-        overlay_groups = config.overlay_groups
-        for probe in xrange(len(playlist)):
-            self._item_idx = (self._item_idx + 1) % len(playlist)
-
-            # At start of playlist with filters: See if filter expires
-            if self._item_idx == 0 and self._tag_filters:
-                self._tag_filter_cycle += 1
-                log("next round. tag filter cycle %d" % self._tag_filter_cycle)
-                max_cycles = self._tag_filters[0].cycles
-                if max_cycles is not None and self._tag_filter_cycle > max_cycles:
-                    self._tag_filters.pop(0)
-
-            item = playlist[self._item_idx]
-            if not item['schedule'].is_active_at(now):
-                continue
+        compiled = self.compiled(config)
+        slots = compiled.slots
+        if not slots:
+            return None
 
-            if self._tag_filters:
-                selector = self._tag_filters[0].selector
-                slot_tags = set(item['asset']['tags']) | (
-                    set(item['extra_tags'].split(','))
-                    if 'extra_tags' in item else set()
-                )
-                if not match_selector(selector, slot_tags):
-                    continue
+        active_slots = compiled.slot_index(now).active_at(now)
 
-            duration = item['duration']
-            if duration == 0: # auto duration?
-                duration = 10
-                metadata = item['asset']['metadata']
-                if 'duration' in metadata:
-                    duration = metadata['duration']
-
-            # Ensure there's at least a small gap between
-            # the end of playback of the previous item and
-            # the preloading of the next one.
-            duration = max(PRELOAD + 1, duration)
-
-            potential_overlay_groups = []
-            for overlay_group in overlay_groups:
-                # Try to filter out overlay groups that cannot
-                # possibly match. Those conditions not handled
-                # here are decided within the Lua code on each
-                # individual display as they depend on the base
-                # asset playing. As that depends on the device,
-                # it cannot be decided here.
-                active = True
-                for condition in overlay_group.get('conditions', ()):
-                    condition_type = condition['condition_type']
-                    if condition_type == 'schedule':
-                        active = active and condition['schedule'].is_active_at(now)
-                    elif condition_type == 'slot_type':
-                        active = active and (
-                            condition['slot_type'] == item['slot_type']
-                        )
-                    elif condition_type == 'not_slot_type':
-                        active = active and (
-                            condition['slot_type'] != item['slot_type']
-                        )
-                if active:
-                    potential_overlay_groups.append(overlay_group['_id'])
-
-            return Item(
-                config_hash = config.config_hash,
-                item_idx = self._item_idx+1,
-                duration = duration,
-                cnt = self._item_idx_count[self._item_idx].next(),
-                rnd = random.randint(0, 2**20),
-                ovr = potential_overlay_groups,
-            )
+        # Visit all active slots in playlist order, starting after
+        # the current item and ending with the current item itself.
+        # The slot at index 0 is passed once along the way, which
+        # might expire the current tag filter.
+        start_idx = self._item_idx
+        if start_idx >= 0:
+            start_idx %= len(slots)
+            pos = bisect_right(active_slots, start_idx)
+            item_idx = self.first_playable(compiled, active_slots[pos:])
+        else:
+            pos, item_idx = len(active_slots), None
+        if item_idx is None:
+            self.on_wrap()
+            item_idx = self.first_playable(compiled, active_slots[:pos])
 
-        # No playable item found?
-        return None
+        # No playable item found? Like a complete round through
+        # the playlist, this ends up at the starting item.
+        if item_idx is None:
+            self._item_idx = (start_idx + len(slots)) % len(slots)
+            return None
+
+        self._item_idx = item_idx
+        slot = slots[self._item_idx]
+
+        # Try to filter out overlay groups that cannot
+        # possibly match.
+        potential_overlay_groups = compiled.overlay_index.potential(
+            slot.slot_type, now
+        )
+
+        self.last_item = Item(
+            config_hash = config.config_hash,
+            item_idx = self._item_idx+1,
+            duration = slot.duration,
+            cnt = self._item_idx_count[self._item_idx].next(),
+            rnd = random.randint(0, 2**20),
+            ovr = potential_overlay_groups,
+        )
+        return self.last_item
+
+class Output(object):
+    """
+    A display output: the item generator for its playlist and
+    the state of the fallback/display suspend handling.
+    """
+    def __init__(self, node, config_source=common_config):
+        # path of the Lua node, relative to the plugin's node
+        self.node = node
+        self.generator = ItemGenerator(config_source)
+
+        self.suspend_depth = 0
+        self.tv_on = True
+
+        # Set once the fallback is playing and the display is in
+        # its final power state because nothing is scheduled.
+        self.idle = False
+
+        # When the idle state was last sent
+        self.idle_sent = 0
+
+    def save_state(self):
+        return (
+            self.generator.save(),
+            self.suspend_depth, self.tv_on, self.idle, self.idle_sent,
+        )
+
+    def restore_state(self, state):
+        (generator_state, self.suspend_depth, self.tv_on,
+            self.idle, self.idle_sent) = state
+        self.generator.restore(generator_state)
+
+    def next_decision(self, now=None):
+        # While idle: The time at which decide might return
+        # something again, either because a slot might become
+        # playable or because the idle state is sent again.
+        wake = self.generator.next_activation(now)
+        resend = self.idle_sent + IDLE_RESEND
+        return resend if wake is None else min(wake, resend)
+
+    def decide(self, should_blank, now=None):
+        # Decides on the next item and the display power status.
+        # Returns None if the fallback is already showing and
+        # nothing has to be sent.
+        if now is None:
+            now = time.time()
+        item = self.generator.get_next(now)
+        if item is None:
+            if self.idle:
+                if now < self.idle_sent + IDLE_RESEND:
+                    return None
+                log("still nothing scheduled. resending fallback")
+                self.idle_sent = now
+                return FALLBACK_ITEM, self.tv_on
+            log("nothing scheduled. using fallback")
+            item = FALLBACK_ITEM
+            if should_blank:
+                # Every time no item is scheduled, suspend_depth
+                # gets increased if setup is configured to suspend
+                # displays. Once MAX_SUSPEND_DEPTH is reached, the
+                # screen is turned off.
+                self.suspend_depth = min(
+                    MAX_SUSPEND_DEPTH, self.suspend_depth+1
+                )
+            self.idle = (
+                self.suspend_depth == MAX_SUSPEND_DEPTH or
+                not should_blank
+            )
+            self.idle_sent = now
+        elif self.suspend_depth > 0:
+            log("items returning. exiting fallback soon")
+            # If an item could be scheduled, but suspend_depth
+            # hasn't returned to zero yet, play fallback item as
+            # a placeholder while the display is slowly turning
+            # back on.
+            item = FALLBACK_ITEM
+            self.suspend_depth -= 1
+            self.idle = False
+        else:
+            self.idle = False
+        self.tv_on = self.suspend_depth < MAX_SUSPEND_DEPTH or not should_blank
+        return item, self.tv_on
 
 class MainPlayer(Plugin):
     def __init__(self):
-        self._item_generator = ItemGenerator()
+        self._output = Output('')
         self._play_next_interrupt = threading.Event()
+        # Set by anything that might make a slot playable
+        # while waiting in wait_for_activation.
+        self._idle_wakeup = threading.Event()
+
+        # The other output of a dual output setup, if this is
+        # the first one.
+        self._sibling = None
+        self._dual_output = None
+        node_name = os.path.basename(os.path.abspath(node_path()))
+        if node_name in DUAL_OUTPUTS:
+            dual_output = os.path.join('..', DUAL_OUTPUTS[
+                1 - DUAL_OUTPUTS.index(node_name)
+            ])
+            if os.path.isdir(node_path(dual_output)):
+                watch_config(dual_output)
+                self._dual_output = dual_output
+                if node_name == DUAL_OUTPUTS[0]:
+                    self._sibling = Output(
+                        dual_output,
+                        lambda: common_config(dual_output),
+                    )
+
+        # Playout plan state on the leader. Tag filter changes
+        # are queued while planning, as the item generator is
+        # already ahead of the current time.
+        self._planning = False
+        self._planned = []
+        self._cursor = None
+        self._plan_revision = 0
+        self._plan_seq = 0
+        self._plan_syncing = None
+        self._plan_synced = None
+        self._plan_resync = False
+        self._plan_peers = None
+        self._plan_announce = None
+        self._plan_announced = 0
+        self._plan_wakeup = threading.Event()
+        self._filter_ops = []
+
+        # Playout plan executed on every device
+        self._plan = []
+        self._plan_started = None
+        self._plan_changed = threading.Event()
+        self._plan_lock = threading.Lock()
+
         start_worker(self.scheduler)
+        start_worker(self.plan_executor)
+
+    def filter_op(self, op, *args):
+        with self._plan_lock:
+            if self._planning:
+                self._filter_ops.append((op, args))
+                self._plan_wakeup.set()
+                return
+        op(*args)
+
+    def outputs(self):
+        # In lock-step mode filters apply to both outputs
+        if self._sibling is not None and self.lock_step():
+            return [self._output, self._sibling]
+        return [self._output]
 
     @rpc_call
     def reset_filter(self):
-        self._item_generator.reset_tag_filter()
+        for output in self.outputs():
+            self.filter_op(output.generator.reset_tag_filter)
+        self._idle_wakeup.set()
 
     @rpc_call
     def add_filter(self, selectors, cycles=None):
         if not isinstance(selectors, list):
             raise ValueError("invalid selectors value")
-        selector = [set(tags) for tags in selectors]
+        selector = compile_selector(selectors)
         if cycles is not None:
             cycles = int(cycles)
-        self._item_generator.apply_tag_filter(TagFilter(
-            selector, cycles
-        ))
+        for output in self.outputs():
+            self.filter_op(output.generator.apply_tag_filter, TagFilter(
+                selector, cycles
+            ))
+        self._idle_wakeup.set()
 
     @rpc_call
     def set_filter(self, selectors, cycles=None):
@@ -183,12 +666,107 @@ class MainPlayer(Plugin):
     def play_next(self):
         log('triggering next item')
         self._play_next_interrupt.set()
+        self._plan_wakeup.set()
+        self._idle_wakeup.set()
+
+    @rpc_call
+    def start_plan(self, seq, start, cut=None):
+        # Called again for the running plan every PLAN_ANNOUNCE
+        # seconds, so restarted followers pick it up. Entries from
+        # `cut` on were dropped by a revision.
+        with self._plan_lock:
+            if self._plan_started == (seq, start, cut):
+                return
+        try:
+            with open(node_path(PLAN_FILE), 'rb') as f:
+                plan = json.load(f)
+        except (IOError, ValueError) as err:
+            log("cannot load playout plan: %s" % (err,))
+            return
+        if plan['seq'] != seq:
+            log("playout plan %d expected, got %d" % (seq, plan['seq']))
+            return
+        # Entries that might already be preloaded are kept, as
+        # the plan is announced again while it's running.
+        keep_until = max(start, wall_time() + PRELOAD + PLAN_CUT_LEAD)
+        entries = [
+            PlanEntry(switch, item, tv_on)
+            for switch, item, tv_on in plan['items']
+            if switch >= keep_until and (cut is None or switch < cut)
+        ]
+        with self._plan_lock:
+            self._plan = [
+                entry for entry in self._plan
+                if entry.switch < keep_until
+            ] + entries
+            self._plan_started = seq, start, cut
+        log("playout plan %d: %d items" % (seq, len(entries)))
+        self._plan_changed.set()
+
+    @rpc_call
+    def cut_plan(self, cut):
+        with self._plan_lock:
+            self._plan = [
+                entry for entry in self._plan
+                if entry.switch < cut
+            ]
+        self._plan_changed.set()
+
+    def wait_for_activation(self):
+        # Block until a slot might become playable, the playlist
+        # config or tag filters change or play_next is called. No
+        # wall events are sent in the meantime.
+        config = common_config()
+        wake = self._output.next_decision()
+        log("idle for %.fs" % (wake - time.time(),))
+        while 1:
+            delay = min(IDLE_CONFIG_CHECK, wake - time.time())
+            if delay <= 0:
+                return
+            if not sleep_until(
+                local_time() + delay,
+                self._idle_wakeup
+            ):
+                log("woken up while idle")
+                self._idle_wakeup.clear()
+                return
+            if common_config() is not config:
+                log("config changed while idle")
+                return
+
+    def lock_step(self):
+        # Both outputs have lock-step mode enabled
+        return (
+            self._dual_output is not None and
+            local_config().dual_output and
+            local_config(self._dual_output).dual_output
+        )
+
+    def plan_mode(self):
+        config = common_config()
+        return (
+            is_leader() and config is not None and
+            config.playout_plan
+        )
 
     def scheduler(self, should_stop):
         next_switch = local_time() + 0.1 + PRELOAD
-        suspend_depth = 0
 
         while not should_stop():
+            if self.lock_step():
+                if self._sibling is None:
+                    # The first output is in control
+                    sleep_until(local_time() + IDLE_CONFIG_CHECK)
+                    next_switch = local_time() + 0.1 + PRELOAD
+                else:
+                    next_switch = self.lock_step_scheduler(
+                        should_stop, next_switch
+                    )
+                continue
+            if self.plan_mode():
+                next_switch = self.plan_scheduler(should_stop, next_switch)
+                continue
+
             # Wake up PRELOAD seconds before the next switch..
             # .. unless interrupted
             self._play_next_interrupt = threading.Event()
@@ -201,30 +779,20 @@ class MainPlayer(Plugin):
                 next_switch = local_time() + INTERRUPT_PRELOAD
 
             # Decide on next item
-            should_blank = local_config().blank
-            item = self._item_generator.get_next()
-            if item is None:
-                log("nothing scheduled. using fallback")
-                item = FALLBACK_ITEM
-                if should_blank:
-                    # Every time no item is scheduled, suspend_depth
-                    # gets increased if setup is configured to suspend
-                    # displays. Once MAX_SUSPEND_DEPTH is reached, the
-                    # screen is turned off.
-                    suspend_depth = min(MAX_SUSPEND_DEPTH, suspend_depth+1)
-            elif suspend_depth > 0:
-                log("items returning. exiting fallback soon")
-                # If an item could be scheduled, but suspend_depth
-                # hasn't returned to zero yet, play fallback item as
-                # a placeholder while the display is slowly turning
-                # back on.
-                item = FALLBACK_ITEM
-                suspend_depth -= 1
+            decision = self._output.decide(local_config().blank)
+            if decision is None:
+                # Fallback content is already showing. Instead of
+                # repeatedly sending it to all screens, sleep until
+                # the schedules say something might be playable.
+                self.wait_for_activation()
+                next_switch = local_time() + 0.1 + PRELOAD
+                continue
+            item, tv_on = decision
 
             log("next up: %r" % (item,))
 
             # Set display power status
-            tv_power(on = suspend_depth < MAX_SUSPEND_DEPTH or not should_blank)
+            tv_power(on = tv_on)
 
             # Send preloading instruction to peers. Note that
             # this eats into the preload time as it's scheduled
@@ -242,3 +810,329 @@ class MainPlayer(Plugin):
 
             # Content has switched now. Decide when to switch next.
             next_switch = next_switch + item.duration
+
+    def lock_step_scheduler(self, should_stop, next_switch):
+        """
+        Runs on the first output while both outputs are in
+        lock-step mode. Items for both outputs are decided here
+        and outputs whose items end at the same time switch within
+        the same event. An idle output is checked again after the
+        fallback duration.
+
+        Returns the time of the next switch once lock-step mode
+        ends.
+        """
+        log("starting lock-step dual output")
+        outputs = [self._output, self._sibling]
+        ends = [next_switch] * len(outputs)
+
+        while not should_stop() and self.lock_step():
+            next_switch = min(ends)
+
+            self._play_next_interrupt = threading.Event()
+            if not sleep_until(
+                next_switch - PRELOAD,
+                self._play_next_interrupt
+            ):
+                log("Interrupted. Playing next item in %.fs" % INTERRUPT_PRELOAD)
+                next_switch = local_time() + INTERRUPT_PRELOAD
+                ends = [next_switch] * len(outputs)
+
+            should_blank = local_config().blank
+            preloads, switches = [], []
+            for idx, output in enumerate(outputs):
+                if ends[idx] > next_switch + SWITCH_TOLERANCE:
+                    continue
+                decision = output.decide(should_blank)
+                if decision is None:
+                    ends[idx] = next_switch + FALLBACK_ITEM.duration
+                    continue
+                item, tv_on = decision
+                log("next up on %s: %r" % (output.node or 'own output', item))
+                preloads.append([output.node, 'preload', [item._asdict()]])
+                switches.append([output.node, 'switch', []])
+                ends[idx] = next_switch + item.duration
+            if not switches:
+                continue
+
+            # The display is shared by both outputs
+            tv_power(on = any(output.tv_on for output in outputs))
+
+            synced_lua_calls(0.25, preloads)
+            switch_time = next_switch - local_time()
+            log("switching time is %f" % (switch_time,))
+            synced_lua_calls(switch_time, switches)
+
+            sleep_until(next_switch)
+
+        log("stopping lock-step dual output")
+        return min(ends)
+
+    def plan_scheduler(self, should_stop, next_switch):
+        """
+        Runs on the leader while the playout plan mode is active.
+        Items are planned up to PLAN_HORIZON seconds ahead and
+        synced as a file to all devices, which then switch on
+        their own according to the shared leader time. Events
+        are only sent for items not yet covered by a synced plan
+        and for cutting the plan once it needs revision.
+
+        Returns the time of the next switch once plan mode ends.
+        """
+        log("starting playout plan")
+        with self._plan_lock:
+            self._planning = True
+        self._planned = []
+        self._cursor = next_switch
+        self._plan_syncing = None
+        self._plan_peers = None
+        self._plan_announce = None
+        config = common_config()
+
+        while not should_stop() and self.plan_mode():
+            now = local_time()
+            peers = set(peer.device_id for peer in get_peers())
+            if self._plan_peers is not None and peers - self._plan_peers:
+                log("peers joined. syncing playout plan again")
+                self._plan_resync = True
+            self._plan_peers = peers
+            with self._plan_lock:
+                filter_ops, self._filter_ops = self._filter_ops, []
+            self._plan_wakeup.clear()
+
+            interrupt = self._play_next_interrupt
+            if interrupt.is_set():
+                log("Interrupted. Playing next item in %.fs" % INTERRUPT_PRELOAD)
+                self._play_next_interrupt = threading.Event()
+                self.revise_plan(now, play_next=True)
+            elif filter_ops or common_config() is not config:
+                self.revise_plan(now)
+            config = common_config()
+            for op, args in filter_ops:
+                op(*args)
+
+            self.start_synced_plan()
+            self.extend_plan(now)
+            self.sync_plan(now)
+            self.announce_plan(now)
+            sleep_until(self.dispatch_planned(now), self._plan_wakeup)
+
+        log("stopping playout plan")
+        self.revise_plan(local_time())
+        self._plan_announce = None
+        with self._plan_lock:
+            self._planning = False
+            filter_ops, self._filter_ops = self._filter_ops, []
+        for op, args in filter_ops:
+            op(*args)
+        self._planned = []
+        if self._cursor is None:
+            return local_time() + 0.1 + PRELOAD
+        return self._cursor
+
+    def revise_plan(self, now, play_next=False):
+        # Drop all planned items not already preloaded and rewind
+        # the item generator to the first of them. Devices drop
+        # their synced items starting at the new cursor.
+        planned = self._planned
+        keep = 0
+        while keep < len(planned) and (
+            planned[keep].switch - PRELOAD <= now + PLAN_CUT_LEAD
+        ):
+            keep += 1
+        dropped = planned[keep:]
+        del planned[keep:]
+        if dropped:
+            self._output.restore_state(dropped[0].state)
+            for planned_item in reversed(dropped):
+                if planned_item.generated is not None:
+                    self._output.generator.rewind(planned_item.generated)
+
+        if play_next:
+            self._cursor = now + INTERRUPT_PRELOAD
+            if planned and planned[-1].switch > now:
+                # The next item is already preloaded. Cut right
+                # after it switched.
+                self._cursor = max(
+                    self._cursor, planned[-1].switch + PRELOAD
+                )
+        elif dropped:
+            self._cursor = dropped[0].switch
+        elif planned:
+            self._cursor = max(
+                planned[-1].switch + planned[-1].item.duration,
+                now + 0.1 + PRELOAD,
+            )
+        else:
+            self._cursor = now + 0.1 + PRELOAD
+
+        self._plan_revision += 1
+        synced_call(0.2, 'cut_plan', self._cursor)
+        if self._plan_announce is not None:
+            seq, start, cut = self._plan_announce
+            if cut is None or self._cursor < cut:
+                self._plan_announce = seq, start, self._cursor
+
+    def extend_plan(self, now):
+        # Extend the plan up to PLAN_HORIZON once it's running low.
+        if self._cursor is None:
+            return
+        if self._cursor > now + PLAN_HORIZON - PLAN_REFILL:
+            return
+        should_blank = local_config().blank
+        unix_now = time.time()
+        for step in xrange(PLAN_MAX_ITEMS):
+            if self._cursor is None or self._cursor >= now + PLAN_HORIZON:
+                break
+            decision_time = self._cursor - PRELOAD
+            unix_time = unix_now + max(0, decision_time - now)
+            state = self._output.save_state()
+            decision = self._output.decide(should_blank, unix_time)
+            if decision is None:
+                # Fallback content is already showing. Continue
+                # planning once the schedules say something might
+                # be playable or the idle state is sent again.
+                wake = self._output.next_decision(unix_time)
+                self._cursor = (
+                    decision_time + max(0, wake - unix_time) +
+                    0.1 + PRELOAD
+                )
+                continue
+            item, tv_on = decision
+            self._planned.append(PlannedItem(
+                self._cursor, item, tv_on, state,
+                self._output.generator.last_item,
+            ))
+            self._cursor += item.duration
+
+    def sync_plan(self, now):
+        # Sync all upcoming items as a new plan if any of them
+        # isn't covered by a synced plan yet.
+        if self._plan_syncing is not None:
+            seq, started, revision, planned = self._plan_syncing
+            if started + PLAN_SYNC_TIMEOUT > now:
+                return
+            log("syncing playout plan %d timed out" % (seq,))
+            self._plan_syncing = None
+        planned = [
+            planned_item for planned_item in self._planned
+            if planned_item.switch >= now + PLAN_START_MARGIN
+        ]
+        if not planned or not self._plan_resync and all(
+            planned_item.by_plan for planned_item in planned
+        ):
+            return
+        self._plan_resync = False
+        self._plan_seq += 1
+        self._plan_syncing = (
+            self._plan_seq, now, self._plan_revision, planned
+        )
+        log("syncing playout plan %d: %d items" % (
+            self._plan_seq, len(planned)
+        ))
+        synced_json(PLAN_FILE, dict(
+            seq = self._plan_seq,
+            items = [
+                [planned_item.switch, planned_item.item._asdict(), planned_item.tv_on]
+                for planned_item in planned
+            ],
+        ), self.on_plan_synced, self._plan_seq)
+
+    def on_plan_synced(self, fname, seq):
+        # Called once all devices have the plan file
+        self._plan_synced = seq
+        self._plan_wakeup.set()
+
+    def start_synced_plan(self):
+        seq, self._plan_synced = self._plan_synced, None
+        if seq is None or self._plan_syncing is None:
+            return
+        syncing_seq, started, revision, planned = self._plan_syncing
+        if seq != syncing_seq:
+            return
+        self._plan_syncing = None
+        if revision != self._plan_revision:
+            log("playout plan %d outdated" % (seq,))
+            return
+        start = local_time() + PLAN_START_MARGIN
+        for planned_item in planned:
+            if planned_item.switch >= start:
+                planned_item.by_plan = True
+        self._plan_announce = seq, start, None
+        self._plan_announced = local_time()
+        synced_call(0.25, 'start_plan', seq, start)
+
+    def announce_plan(self, now):
+        # Followers ignore a plan they already started
+        if self._plan_announce is None:
+            return
+        if now < self._plan_announced + PLAN_ANNOUNCE:
+            return
+        self._plan_announced = now
+        synced_call(0.25, 'start_plan', *self._plan_announce)
+
+    def dispatch_planned(self, now):
+        # Send events for all due items that aren't covered by a
+        # synced plan. Returns the time the next one is due.
+        planned = self._planned
+        while planned and planned[0].switch + planned[0].item.duration < now:
+            planned.pop(0)
+        for planned_item in planned:
+            if planned_item.by_plan or planned_item.dispatched:
+                continue
+            if planned_item.switch - PRELOAD > now:
+                return min(now + 1, planned_item.switch - PRELOAD)
+            planned_item.dispatched = True
+            log("next up: %r" % (planned_item.item,))
+            tv_power(on = planned_item.tv_on)
+            synced_lua_call(0.25, 'preload', planned_item.item._asdict())
+            synced_lua_call(planned_item.switch - local_time(), 'switch')
+        return now + 1
+
+    def sleep_until_wall(self, t, interrupt=None):
+        while 1:
+            delay = t - wall_time()
+            if delay <= 0:
+                return True
+            if not sleep_until(local_time() + min(1, delay), interrupt):
+                return False
+
+    def plan_executor(self, should_stop):
+        # Running on all devices: Plays synced plan items
+        # according to the shared leader time.
+        offset = None
+        while not should_stop():
+            self._plan_changed.clear()
+            now = wall_time()
+
+            # A different leader clock means a new leader and
+            # the plan is meaningless.
+            new_offset = now - local_time()
+            if offset is not None and abs(new_offset - offset) > 1:
+                log("leader time changed. dropping playout plan")
+                with self._plan_lock:
+                    self._plan = []
+                    self._plan_started = None
+            offset = new_offset
+
+            with self._plan_lock:
+                while self._plan and self._plan[0].switch < now:
+                    self._plan.pop(0)
+                entry = self._plan[0] if self._plan else None
+            if entry is None:
+                sleep_until(local_time() + 1, self._plan_changed)
+                continue
+            if not self.sleep_until_wall(
+                entry.switch - PRELOAD, self._plan_changed
+            ):
+                continue
+            with self._plan_lock:
+                if not self._plan or self._plan[0] is not entry:
+                    continue
+            local_tv_power(entry.tv_on)
+            local_lua_call('preload', entry.item)
+            self.sleep_until_wall(entry.switch)
+            local_lua_call('switch')
+            with self._plan_lock:
+                if self._plan and self._plan[0] is entry:
+                    self._plan.pop(0)
@@ -7,6 +7,7 @@ from p2plib import (
     PeerGroup,
     ROLE_LEADER, ROLE_FOLLOWER,
     DIRECTION_LEADER_TO_PEER, DIRECTION_PEER_TO_LEADER,
+    COALESCE_DELAY, MULTICAST_GROUP,
 )
 
 from p2pfile import (
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# Benchmarks the duplicate detection of Peer.add_seen_msg_id with
+# many peers each receiving messages at a steady rate. Time is
+# simulated, so the replay window expires ids exactly as it would
+# on a device, independent of how fast this machine is.
+#
+# Run from the .pylib directory:
+#
+#   python hosted/p2p/bench_replay.py [peers] [msgs/s per peer] [seconds]
+#
+# Defaults to 40 peers at 300 msgs/s for 10 seconds.
+import sys, os, time, types
+
+# p2plib takes its clock from the hosted module. Provide just that,
+# so the benchmark doesn't set up a complete node.
+clock = [1000.0]
+hosted = types.ModuleType('hosted')
+hosted.monotonic_time = lambda: clock[0]
+hosted.get_random_bytes = os.urandom
+sys.modules['hosted'] = hosted
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import p2plib
+
+# Discarded messages are logged, which would dominate the timing.
+p2plib.log = lambda msg: None
+
+def bench(num_peers, rate, seconds):
+    peers = [p2plib.Peer('10.0.0.%d' % idx) for idx in range(num_peers)]
+    msg_ids = [os.urandom(16) for _ in xrange(num_peers * rate * seconds)]
+    clock[0] = 1000.0
+    accepted = 0
+    next_id = iter(msg_ids).next
+    started = time.time()
+    for tick in xrange(rate * seconds):
+        clock[0] += 1.0 / rate
+        for peer in peers:
+            accepted += peer.add_seen_msg_id(next_id())
+    elapsed = time.time() - started
+
+    # Every id is rejected while still within the window.
+    duplicates = sum(
+        peer.add_seen_msg_id(msg_id)
+        for peer, msg_id in zip(peers, msg_ids[-num_peers:])
+    )
+    return accepted, len(msg_ids), duplicates, elapsed
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    num_peers, rate, seconds = args + [40, 300, 10][len(args):]
+    accepted, total, duplicates, elapsed = bench(num_peers, rate, seconds)
+    print "%d peers at %d msgs/s for %ds of simulated time" % (
+        num_peers, rate, seconds
+    )
+    print "accepted %d of %d messages, %d duplicates accepted" % (
+        accepted, total, duplicates
+    )
+    print "%.2fus per message, %.0f msgs/s handled" % (
+        elapsed / total * 1e6, total / elapsed
+    )